@@ -0,0 +1,502 @@
+# build_reference_corpus.py
+
+import os
+import time
+import uuid
+import argparse
+from functools import partial
+import numpy as np
+import pandas as pd
+
+from parser_utils import str2bool, list_of_bools, list_of_ints, list_of_strings
+from image_preprocessing_utils import check_image_dtype, generate_expanded_dataset, file_content_hash
+from feature_calculation_utils import generate_pool_dict, compute_image_statistics, export_features, iter_feature_columns
+from rank_calculation_utils import (
+    load_reference_scaler_stats, process_adjustment_division_feature, generate_entropy_df, SCALER_STATS_FILE, DISCRETE_FEATURES
+)
+from run_sample import create_worker_pool, prepare_sample_dataset, load_sample_images
+from resource_planner import available_cpus, plan_stages, plan_entropy_stage, print_plan, bounded_map
+
+# file recording the samples included in the reference corpus and their content hash
+MANIFEST_FILE = 'corpus_manifest.csv'
+MANIFEST_COLUMNS = ['sample', 'path', 'size', 'mtime', 'hash']
+
+# scaler statistics columns: 'mean' and 'scale' are used to scale features for entropy, 
+# 'count', 'grid_mean' and 'grid_scale' are the current moments of the grid column
+SCALER_STATS_COLUMNS = ['contrast_adjustment', 'division', 'feature', 'mean', 'scale', 'count', 'grid_mean', 'grid_scale']
+
+def write_csv_atomic(df, path):
+    """
+    Writes a DataFrame to a CSV file atomically, by writing a uniquely named temporary 
+    file and renaming it over the destination.
+
+    Parameters:
+    df (pd.DataFrame): DataFrame to be written.
+    path (str): Path to the CSV file.
+
+    Returns:
+    None
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+def scan_samples(samples_folder, manifest, pool):
+    """
+    Finds the .nc samples of a folder that are new or changed with respect to the manifest,
+    and the manifest samples whose file was removed from the folder.
+
+    Files whose size and modification time match the manifest are not read. The others
+    are hashed in parallel and compared by content.
+
+    Parameters:
+    samples_folder (str): Folder containing the .nc sample files.
+    manifest (pd.DataFrame): Current corpus manifest.
+    pool (multiprocessing.Pool): Worker pool used to hash files.
+
+    Returns:
+    tuple: (entries, changed, removed), where entries is the list of manifest rows (dicts) 
+           for all samples found, changed lists the rows of new or changed samples and removed 
+           lists the names of the manifest samples that were not found.
+    """
+    known = {row['sample']: row for row in manifest.to_dict('records')}
+    entries = []
+    to_hash = []
+    for filename in sorted(os.listdir(samples_folder)):
+        if not filename.endswith('.nc'):
+            continue
+        path = os.path.join(samples_folder, filename)
+        stat = os.stat(path)
+        entry = {'sample': filename.split('.')[0], 'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': None}
+        previous = known.get(entry['sample'])
+        if previous is not None and previous['size'] == entry['size'] and previous['mtime'] == entry['mtime']:
+            entry['hash'] = previous['hash']
+        else:
+            to_hash.append(entry)
+        entries.append(entry)
+
+    hashes = pool.map(file_content_hash, [entry['path'] for entry in to_hash])
+    changed = []
+    for entry, content_hash in zip(to_hash, hashes):
+        entry['hash'] = content_hash
+        previous = known.get(entry['sample'])
+        if previous is None or previous['hash'] != content_hash:
+            changed.append(entry)
+    found = {entry['sample'] for entry in entries}
+    removed = [sample for sample in known if sample not in found]
+    return entries, changed, removed
+
+def compute_sample_features(sample_path, division_list, contrast_adjustment_options, feature_list, pool, memory_fraction=0.8, max_workers=None):
+    """
+    Computes the subcube features of a reference sample for all divisions and contrast adjustments,
+    with the concurrency of each stage chosen from the sample's crop size and the available memory.
+
+    Parameters:
+    sample_path (str): Path to the .nc sample file.
+    division_list (list of int): List of division values.
+    contrast_adjustment_options (list of bool): List of contrast adjustment flags.
+    feature_list (list of str): List of feature names.
+    pool (multiprocessing.Pool): Worker pool.
+    memory_fraction (float): Fraction of the available memory that may be used (default is 0.8).
+    max_workers (int or None): Size of the worker pool, or None if unknown (default is None).
+
+    Returns:
+    list of dict: Feature tables as returned by compute_image_statistics.
+    """
+    check_image_dtype(sample_path)
+    dfdataset = prepare_sample_dataset(sample_path, None, None)
+    dfcrops_expanded = generate_expanded_dataset(dfdataset, contrast_adjustment_options)
+    row = dfdataset.iloc[0]
+    crop_shape = (int(row['z_fin']) - int(row['z_ini']), int(row['x_fin']) - int(row['x_ini']), int(row['y_fin']) - int(row['y_ini']))
+    plan = plan_stages(crop_shape, contrast_adjustment_options, division_list, feature_list,
+                       memory_fraction=memory_fraction, max_workers=max_workers)
+    print_plan(plan)
+    sample_images = load_sample_images(dfcrops_expanded, pool, plan['loading']['workers'])
+    pool_dict = generate_pool_dict(sample_images, division_list)
+    prepared_dict_items = [((key[0], key[1], key[2]), value) for key, value in pool_dict.items()]
+    return bounded_map(pool, partial(compute_image_statistics, feature_list=feature_list), prepared_dict_items,
+                       plan['features']['workers'], plan['features']['chunksize'])
+
+def iter_grid_feature_columns(df_grid, feature_list, selected_features=None, skipped_samples=()):
+    """
+    Yields the feature columns of every sample of a reference feature grid, ready to be
+    sent to entropy tasks. Subcubes with any missing feature value are discarded.
+
+    Parameters:
+    df_grid (pd.DataFrame): Reference feature grid for one contrast adjustment and division.
+    feature_list (list of str): List of feature names.
+    selected_features (list of str or None): Features to yield, or None to yield all of 
+                                             feature_list (default is None).
+    skipped_samples (iterable of str): Samples not to yield (default is none).
+
+    Yields:
+    tuple: (sample, (contrast_adjustment, division, feature, None, values)).
+    """
+    df_grid = df_grid.dropna(subset=feature_list)
+    df_grid = df_grid[~df_grid['sample'].isin(list(skipped_samples))]
+    for (sample, adjustment, division), df_sample in df_grid.groupby(['sample', 'contrast_adjustment', 'division']):
+        for feature in (feature_list if selected_features is None else selected_features):
+            yield sample, (adjustment, division, feature, None, df_sample[feature].values.astype(np.float64))
+
+def sample_entropy_task(task, features_folder, scaler_stats):
+    """
+    Computes the entropy of one (sample, combination) task.
+
+    Parameters:
+    task (tuple): (sample, combination), with combination as expected by
+                  process_adjustment_division_feature.
+    features_folder (str): Path to the folder containing all feature grids.
+    scaler_stats (dict): Reference scaler statistics.
+
+    Returns:
+    list: A list of entropy results for the given task.
+    """
+    sample, combination = task
+    return process_adjustment_division_feature(combination, features_folder, sample, scaler_stats=scaler_stats)
+
+def grid_moments(df_grid, feature_list):
+    """
+    Computes the count, mean and standard deviation of each feature column of a grid, 
+    ignoring missing values.
+
+    Parameters:
+    df_grid (pd.DataFrame): Feature rows of one contrast adjustment and division.
+    feature_list (list of str): List of feature names.
+
+    Returns:
+    dict: Dictionary mapping each feature to a (count, mean, std) tuple.
+    """
+    moments = {}
+    for feature in feature_list:
+        values = df_grid[feature].values.astype(np.float64)
+        values = values[~np.isnan(values)]
+        moments[feature] = (len(values), values.mean(), values.std()) if len(values) else (0, np.nan, np.nan)
+    return moments
+
+def merge_moments(first, second):
+    """
+    Combines the (count, mean, std) moments of two disjoint sets of values.
+
+    Parameters:
+    first (tuple): (count, mean, std) of the first set.
+    second (tuple): (count, mean, std) of the second set.
+
+    Returns:
+    tuple: (count, mean, std) of the union of both sets.
+    """
+    (n1, mean1, std1), (n2, mean2, std2) = first, second
+    if n2 == 0:
+        return first
+    if n1 == 0:
+        return second
+    n = n1 + n2
+    delta = mean2 - mean1
+    squares = n1 * std1 ** 2 + n2 * std2 ** 2 + delta ** 2 * n1 * n2 / n
+    return n, mean1 + delta * n2 / n, np.sqrt(squares / n)
+
+def read_saved_stats(stats_path):
+    """
+    Reads the scaler statistics written by a previous build.
+
+    Parameters:
+    stats_path (str): Path to the scaler statistics CSV file.
+
+    Returns:
+    dict: Dictionary mapping (contrast_adjustment, division, feature) to a row dict with the 
+          SCALER_STATS_COLUMNS values. Files written without grid moments have NaN counts.
+    """
+    if not os.path.exists(stats_path):
+        return {}
+    df_stats = pd.read_csv(stats_path).reindex(columns=SCALER_STATS_COLUMNS)
+    return {
+        (row['contrast_adjustment'], row['division'], row['feature']): row
+        for row in df_stats.to_dict('records')
+    }
+
+def file_ends_with_newline(path):
+    """
+    Checks that a text file is empty or ends with a newline, so rows can be appended to it.
+
+    Parameters:
+    path (str): Path to the file.
+
+    Returns:
+    bool: True if the file is empty or its last byte is a newline.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+def update_grid_tables(features_folder, df_new_features, replaced_samples, division_list, contrast_adjustment_options, feature_list, saved_stats):
+    """
+    Adds the features of new samples to the reference feature grids, removing previous
+    rows of changed or deleted samples, and returns the moments of the updated grids.
+
+    Grids with no rows to remove are appended to, and their moments are combined from 
+    the saved ones and those of the new rows, so that the existing rows are not read. 
+    Other grids are rewritten atomically and their moments computed from all rows.
+
+    Parameters:
+    features_folder (str): Path to the folder containing all feature grids.
+    df_new_features (pd.DataFrame): Features of the new samples.
+    replaced_samples (list of str): Names of the samples whose previous rows are removed.
+    division_list (list of int): List of division values.
+    contrast_adjustment_options (list of bool): List of contrast adjustment flags.
+    feature_list (list of str): List of feature names.
+    saved_stats (dict): Scaler statistics of the previous build, as returned by read_saved_stats.
+
+    Returns:
+    dict: Dictionary mapping (contrast_adjustment, division, feature) to the (count, mean, std) 
+          moments of the updated grid column.
+    """
+    moments = {}
+    for adjustment in contrast_adjustment_options:
+        adjustment_folder = 'ajuste_surmas' if adjustment else 'sem_ajuste'
+        for division in division_list:
+            grid_path = os.path.join(features_folder, f'grid_features_{adjustment_folder}_{division}.csv')
+            keys = [(adjustment, division, feature) for feature in feature_list]
+            df_grid = df_new_features[
+                (df_new_features['contrast_adjustment'] == adjustment) & (df_new_features['division'] == division)
+            ]
+
+            # rows of an interrupted build may already be in the grid, so the sample column is checked
+            appendable = (
+                os.path.exists(grid_path) and file_ends_with_newline(grid_path)
+                and all(key in saved_stats and saved_stats[key]['count'] >= 0 for key in keys)
+            )
+            if appendable:
+                header = list(pd.read_csv(grid_path, nrows=0).columns)
+                grid_samples = set(pd.read_csv(grid_path, usecols=['sample'])['sample'])
+                appendable = set(header) == set(df_grid.columns) and not grid_samples & set(replaced_samples)
+
+            if appendable:
+                df_grid[header].to_csv(grid_path, mode='a', header=False, index=False)
+                new_moments = grid_moments(df_grid, feature_list)
+                for key in keys:
+                    saved = saved_stats[key]
+                    moments[key] = merge_moments((int(saved['count']), saved['grid_mean'], saved['grid_scale']), new_moments[key[2]])
+                print(f'Reference grid {grid_path} appended ({df_grid.shape[0]} subcubes).', flush=True)
+            else:
+                if os.path.exists(grid_path):
+                    df_existing = pd.read_csv(grid_path)
+                    df_existing = df_existing[~df_existing['sample'].isin(replaced_samples)]
+                    df_grid = pd.concat([df_existing, df_grid], ignore_index=True)
+                write_csv_atomic(df_grid, grid_path)
+                moments.update({(adjustment, division, feature): value for feature, value in grid_moments(df_grid, feature_list).items()})
+                print(f'Reference grid {grid_path} rewritten ({df_grid.shape[0]} subcubes).', flush=True)
+    return moments
+
+def select_scaler_stats(moments, saved_stats, scaler_drift_tol, refresh_all=False):
+    """
+    Chooses the scaler statistics used for entropy and the features whose reference 
+    entropies must be recomputed.
+
+    Reference entropies of continuous features depend on the scaling, so their statistics 
+    are frozen until the grid moments drift from them by more than scaler_drift_tol, in 
+    units of the frozen scale, and are then refreshed together with a recompute of all 
+    reference entropies of that feature. Value count entropies of discrete features do not 
+    change under scaling, so their statistics are always refreshed and never trigger a 
+    recompute.
+
+    Parameters:
+    moments (dict): Grid moments, as returned by update_grid_tables.
+    saved_stats (dict): Scaler statistics of the previous build, as returned by read_saved_stats.
+    scaler_drift_tol (float): Largest change of the mean or scale, relative to the frozen 
+                              scale, that keeps the frozen statistics.
+    refresh_all (bool): Whether to refresh all statistics and recompute all reference 
+                        entropies (default is False).
+
+    Returns:
+    tuple: (scaler_stats, recompute), where scaler_stats maps (contrast_adjustment, division, 
+           feature) to a (mean, scale) tuple and recompute lists the keys to recompute.
+    """
+    scaler_stats = {}
+    recompute = []
+    for key, (count, mean, std) in moments.items():
+        grid_stats = (mean, std if std != 0 else 1.0)
+        saved = saved_stats.get(key)
+        if refresh_all or saved is None:
+            scaler_stats[key] = grid_stats
+            recompute.append(key)
+        elif key[2] in DISCRETE_FEATURES:
+            scaler_stats[key] = grid_stats
+        else:
+            frozen = (saved['mean'], saved['scale'])
+            drift = max(abs(grid_stats[0] - frozen[0]), abs(grid_stats[1] - frozen[1])) / frozen[1]
+            if drift > scaler_drift_tol:
+                print(f'Scaler statistics of {key} drifted by {drift:.4f}, reference entropies recomputed.', flush=True)
+                scaler_stats[key] = grid_stats
+                recompute.append(key)
+            else:
+                scaler_stats[key] = frozen
+    return scaler_stats, recompute
+
+def write_scaler_stats(stats_path, scaler_stats, moments, saved_stats):
+    """
+    Writes the scaler statistics and grid moments, keeping saved rows of other grids.
+
+    Parameters:
+    stats_path (str): Path to the scaler statistics CSV file.
+    scaler_stats (dict): Statistics used for entropy, as returned by select_scaler_stats.
+    moments (dict): Grid moments, as returned by update_grid_tables.
+    saved_stats (dict): Scaler statistics of the previous build.
+
+    Returns:
+    None
+    """
+    rows = {key: row for key, row in saved_stats.items()}
+    for key, (mean, scale) in scaler_stats.items():
+        count, grid_mean, grid_scale = moments[key]
+        rows[key] = dict(zip(SCALER_STATS_COLUMNS, key + (mean, scale, count, grid_mean, grid_scale)))
+    write_csv_atomic(pd.DataFrame(list(rows.values()), columns=SCALER_STATS_COLUMNS), stats_path)
+
+def build_reference_corpus(samples_folder, features_folder, data_entropy_path, division_list, contrast_adjustment_options, feature_list, refresh_all_entropy=False, scaler_drift_tol=0.01, processes=None, memory_fraction=0.8):
+    start = time.time()
+    os.makedirs(features_folder, exist_ok=True)
+    manifest_path = os.path.join(features_folder, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        manifest = pd.read_csv(manifest_path)
+    else:
+        manifest = pd.DataFrame(columns=MANIFEST_COLUMNS)
+
+    pool_size = processes or available_cpus()
+    pool = create_worker_pool(pool_size)
+    try:
+        # detect new, changed or removed samples
+        scan_start = time.time()
+        print('Sample scan began.', flush=True)
+        entries, changed, removed = scan_samples(samples_folder, manifest, pool)
+        scan_end = time.time()
+        print(f'Sample scan ended. {len(entries)} samples found, {len(changed)} new or changed, {len(removed)} removed. '
+              f'Time elapsed (seconds): {scan_end - scan_start}', flush=True)
+
+        # calculate features of new or changed samples only
+        feature_start = time.time()
+        print('Feature calculation started.', flush=True)
+        features_results = {}
+        for entry in changed:
+            print(f'Sample: {entry["sample"]}', flush=True)
+            try:
+                features_results[entry['sample']] = compute_sample_features(entry['path'], division_list, contrast_adjustment_options, feature_list, pool,
+                                                                       memory_fraction, pool_size)
+            # invalid samples stop run_sample stages with sys.exit; here they are only skipped
+            except (Exception, SystemExit) as e:
+                print(f'Sample {entry["sample"]} skipped: {e!r}', flush=True)
+        feature_end = time.time()
+        print(f'Feature calculation ended. Time elapsed (seconds): {feature_end - feature_start}', flush=True)
+
+        # skipped samples keep their previous manifest row, if any, so that they are retried on the next build
+        failed = {entry['sample'] for entry in changed} - set(features_results)
+        previous_entries = {row['sample']: row for row in manifest.to_dict('records')}
+        entries = [
+            previous_entries.get(entry['sample']) if entry['sample'] in failed else entry
+            for entry in entries
+        ]
+        entries = [entry for entry in entries if entry is not None]
+
+        # append features to the reference grids, drop removed samples and update the grid moments
+        grids_changed = bool(features_results) or bool(removed)
+        stats_path = os.path.join(features_folder, SCALER_STATS_FILE)
+        replaced_samples = list(features_results) + removed
+        recompute = []
+        if grids_changed or refresh_all_entropy:
+            if removed:
+                print(f'Samples removed from the corpus: {removed}', flush=True)
+            new_features = [export_features(results, sample, feature_list) for sample, results in features_results.items()]
+            if new_features:
+                df_new_features = pd.concat(new_features, ignore_index=True)
+            else:
+                df_new_features = pd.DataFrame(columns=['sample', 'contrast_adjustment', 'division', 'subcube'] + feature_list)
+            saved_stats = read_saved_stats(stats_path)
+            moments = update_grid_tables(features_folder, df_new_features, replaced_samples, division_list, contrast_adjustment_options, feature_list, saved_stats)
+            scaler_stats, recompute = select_scaler_stats(moments, saved_stats, scaler_drift_tol, refresh_all_entropy)
+            write_scaler_stats(stats_path, scaler_stats, moments, saved_stats)
+        else:
+            print('Reference grids are up to date.', flush=True)
+            scaler_stats = load_reference_scaler_stats(features_folder, contrast_adjustment_options, division_list, feature_list)
+
+        # entropies of new samples, plus those of the other reference samples for the features
+        # whose scaler statistics were refreshed
+        entropy_results = []
+        if grids_changed or refresh_all_entropy:
+            entropy_start = time.time()
+            print('Entropy calculation began.', flush=True)
+            tasks = [
+                (sample, combination)
+                for sample, results in features_results.items()
+                for combination in iter_feature_columns(results, feature_list)
+            ]
+            for adjustment in contrast_adjustment_options:
+                adjustment_folder = 'ajuste_surmas' if adjustment else 'sem_ajuste'
+                for division in division_list:
+                    selected_features = [feature for feature in feature_list if (adjustment, division, feature) in recompute]
+                    if not selected_features:
+                        continue
+                    df_grid = pd.read_csv(
+                        os.path.join(features_folder, f'grid_features_{adjustment_folder}_{division}.csv'),
+                        usecols=['sample', 'contrast_adjustment', 'division'] + feature_list
+                    )
+                    tasks.extend(iter_grid_feature_columns(df_grid, feature_list, selected_features, features_results))
+            print(f'{len(tasks)} entropy tasks, {len(recompute)} grid features recomputed for all reference samples.', flush=True)
+            # tasks come from several samples, so the plan is sized for the longest feature column
+            entropy_plan = plan_entropy_stage(len(tasks), max((len(task[1][4]) for task in tasks), default=0), memory_fraction, pool_size)
+            entropy_results = bounded_map(pool, partial(sample_entropy_task, features_folder=features_folder, scaler_stats=scaler_stats), tasks,
+                                          entropy_plan['workers'], entropy_plan['chunksize'])
+            entropy_end = time.time()
+            print(f'Entropy calculation ended. Time elapsed (seconds): {entropy_end - entropy_start}.', flush=True)
+    finally:
+        pool.close()
+        pool.join()
+
+    # update the reference entropy table: rows of changed or removed samples are dropped and
+    # new or recomputed values replace the previous ones
+    if grids_changed or refresh_all_entropy:
+        index = ['sample', 'division', 'contrast_adjustment']
+        if os.path.exists(data_entropy_path):
+            data_entropy = pd.read_csv(data_entropy_path)
+            data_entropy = data_entropy[~data_entropy['sample'].isin(replaced_samples)]
+        else:
+            data_entropy = pd.DataFrame(columns=index + feature_list)
+        if entropy_results:
+            data_entropy = generate_entropy_df(entropy_results).set_index(index).combine_first(data_entropy.set_index(index)).reset_index()
+        columns = index + feature_list
+        data_entropy = data_entropy[columns + [column for column in data_entropy.columns if column not in columns]]
+        write_csv_atomic(data_entropy, data_entropy_path)
+        print(f'Entropy file saved to {data_entropy_path}', flush=True)
+    else:
+        print('Reference entropy table is up to date.', flush=True)
+
+    # the manifest is written last, so an interrupted build reprocesses its samples
+    write_csv_atomic(pd.DataFrame(entries, columns=MANIFEST_COLUMNS), manifest_path)
+    print(f'Corpus manifest saved to {manifest_path}', flush=True)
+
+    end = time.time()
+    print(f'Total time (seconds): {end - start}', flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-samples_folder", type=str, required=True)
+    parser.add_argument("-features_folder", type=str, required=True)
+    parser.add_argument("-data_entropy_path", type=str, required=True)
+    parser.add_argument("-division_list", type=list_of_ints, default='2,3,4,5,6,7,8,9,10')
+    parser.add_argument("-contrast_adjustment_options", type=list_of_bools, default='True, False')
+    parser.add_argument("-feature_list", type=list_of_strings, default='mean,std,min,max,skewness,kurtosis,"variation coefficient",median')
+    parser.add_argument("-refresh_all_entropy", type=str2bool, default=False)
+    parser.add_argument("-scaler_drift_tol", type=float, default=0.01)
+    parser.add_argument("-processes", type=int, default=None)
+    parser.add_argument("-memory_fraction", type=float, default=0.8)
+
+    args = parser.parse_args()
+    build_reference_corpus(samples_folder = args.samples_folder,
+                           features_folder = args.features_folder,
+                           data_entropy_path = args.data_entropy_path,
+                           division_list = args.division_list,
+                           contrast_adjustment_options = args.contrast_adjustment_options,
+                           feature_list = args.feature_list,
+                           refresh_all_entropy = args.refresh_all_entropy,
+                           scaler_drift_tol = args.scaler_drift_tol,
+                           processes = args.processes,
+                           memory_fraction = args.memory_fraction)
@@ -1,8 +1,6 @@
 ## feature_calculation_utils.py
 
 import numpy as np
-import pandas as pd
-from scipy.stats import skew, kurtosis, variation
 from multiprocessing import Manager
 import os
 
@@ -31,68 +29,276 @@ def generate_pool_dict(sample_images, division_list):
     pool_dict = manager.dict(image_dict)
     return pool_dict
 
-def compute_image_statistics(dictionary_items, feature_list):
+def get_feature_operations():
+    """
+    Returns the functions used to compute each supported feature. scipy.stats is 
+    imported here so that it is only loaded by the processes computing features.
+
+    Returns:
+    dict: Dictionary mapping feature names to functions of a 1D numpy array.
+    """
+    from scipy.stats import skew, kurtosis, variation
+
+    return {
+        'mean': lambda part: np.mean(part),
+        'std': lambda part: np.std(part),
+        'min': lambda part: np.min(part),
+        'max': lambda part: np.max(part),
+        'skewness': lambda part: skew(part),
+        'kurtosis': lambda part: kurtosis(part),
+        'variation coefficient': lambda part: variation(part),
+        'median': lambda part: np.median(part)
+    }
+
+# features supported by the approximate mode: they are derived from power sums, so their 
+# leave-one-group-out values come from the same single pass over the subsample. min and 
+# max are biased by subsampling and the median has no such update, so they are excluded.
+APPROXIMATE_FEATURES = ['mean', 'std', 'skewness', 'kurtosis', 'variation coefficient']
+
+def sample_without_replacement(n, k, rng):
+    """
+    Draws k distinct integers from range(n) using memory proportional to k, unlike 
+    rng.choice(n, k, replace=False), which allocates a permutation of range(n) for large k.
+
+    Parameters:
+    n (int): Size of the population.
+    k (int): Number of integers to draw, at most n.
+    rng (np.random.Generator): Random generator.
+
+    Returns:
+    np.ndarray: Sorted int64 array of k distinct integers.
+    """
+    if k > n // 2:
+        # draw the excluded positions instead, a boolean mask costs one byte per position
+        mask = np.ones(n, dtype=bool)
+        mask[sample_without_replacement(n, n - k, rng)] = False
+        return np.flatnonzero(mask)
+    selected = np.unique(rng.integers(0, n, k + k // 8 + 16))
+    while len(selected) < k:
+        selected = np.unique(np.concatenate([selected, rng.integers(0, n, k - len(selected) + 16)]))
+    if len(selected) > k:
+        selected = np.sort(selected[rng.permutation(len(selected))[:k]])
+    return selected
+
+def subsample_indices(shape, sample_fraction, sampling, n_groups, rng):
+    """
+    Selects a subsample of voxel positions inside a subcube for the approximate mode and 
+    splits it into disjoint groups at random.
+
+    Parameters:
+    shape (tuple): Shape (z, x, y) of the subcube.
+    sample_fraction (float): Fraction of the subcube voxels to keep, in (0, 1].
+    sampling (str): 'random' draws voxels uniformly without replacement, 'strided' keeps a 
+                    regular 3D grid with a spacing of sample_fraction ** (-1/3) voxels along 
+                    each axis, from a random start, so that no plane is favoured.
+    n_groups (int): Number of disjoint groups the subsample is split into.
+    rng (np.random.Generator): Random generator.
+
+    Returns:
+    tuple: Index arrays that select the subsample when used to index the subcube (the 
+           result is flattened by the caller), and an array with the group of each 
+           selected voxel.
+    """
+    n_voxels = int(np.prod(shape))
+    if sampling == 'random':
+        n_selected = min(n_voxels, max(n_groups, int(round(n_voxels * sample_fraction))))
+        indices = np.unravel_index(sample_without_replacement(n_voxels, n_selected, rng), shape)
+    elif sampling == 'strided':
+        # non-integer spacing keeps the fraction close to sample_fraction along every axis
+        axis_fraction = sample_fraction ** (1 / 3)
+        axis_indices = []
+        for edge in shape:
+            n_axis = min(edge, max(1, int(round(edge * axis_fraction))))
+            spacing = edge / n_axis
+            axis_indices.append((rng.uniform(0, spacing) + np.arange(n_axis) * spacing).astype(np.int64))
+        indices = np.ix_(*axis_indices)
+        n_selected = int(np.prod([len(axis) for axis in axis_indices]))
+        if n_selected < n_groups:
+            raise ValueError(f'Strided subsample of {n_selected} voxels cannot be split into {n_groups} groups')
+    else:
+        raise ValueError(f'Unknown sampling method: {sampling}')
+    groups = rng.permutation(n_selected) % n_groups
+    return indices, groups
+
+def moment_features(power_sums, shift):
+    """
+    Computes the moment-based features from the power sums of shifted values, with the 
+    same definitions as the exact mode (population moments, Fisher kurtosis).
+
+    Parameters:
+    power_sums (np.ndarray): Array of shape (..., 5) with the count and the sums of the 
+                             first four powers of (values - shift).
+    shift (float): Value subtracted before the power sums were taken.
+
+    Returns:
+    dict: Dictionary mapping each name of APPROXIMATE_FEATURES to an array of shape (...).
+    """
+    n = power_sums[..., 0]
+    m1, r2, r3, r4 = (power_sums[..., p] / n for p in range(1, 5))
+    m2 = r2 - m1 ** 2
+    m3 = r3 - 3 * m1 * r2 + 2 * m1 ** 3
+    m4 = r4 - 4 * m1 * r3 + 6 * m1 ** 2 * r2 - 3 * m1 ** 4
+    mean = m1 + shift
+    std = np.sqrt(np.maximum(m2, 0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'mean': mean,
+            'std': std,
+            'skewness': m3 / m2 ** 1.5,
+            'kurtosis': m4 / m2 ** 2 - 3,
+            'variation coefficient': std / mean
+        }
+
+def compute_image_statistics(dictionary_items, feature_list, sample_fraction=None, n_replicates=10, sampling='random', seed=None, contrast_values=None):
     """
     Computes statistical features for 3D image subcubes based on the given feature list.
 
+    When sample_fraction is given, features are estimated from a single voxel subsample of 
+    that fraction per subcube, split into n_replicates disjoint groups. The table then also 
+    holds the features of the subsample without each group, used downstream as group 
+    jackknife replicates to measure the sampling error.
+
     Parameters:
     dictionary_items (tuple): A tuple containing ((sample, contrast_adjustment, division), image), 
-                              where the image is a 3D numpy array.
+                              where the image is a 3D numpy array, or a sample dataset row 
+                              pointing to a cached volume that is memory-mapped here.
     feature_list (list of str): List of feature names to compute for each subcube, such as 
                                 'mean', 'std', 'min', 'max', 'skewness', 'kurtosis', etc.
+    sample_fraction (float or None): Fraction of voxels used per subcube, or None to use 
+                                     all voxels (default is None).
+    n_replicates (int): Number of disjoint groups of the subsample in approximate mode.
+    sampling (str): Subsampling method, 'random' or 'strided'.
+    seed (int or None): Seed of the subsampling.
+    contrast_values (tuple or None): (voidmean, rockmedian) of the sample. When given, the 
+                                     image is the raw uint16 volume and the contrast adjustment 
+                                     is applied here, to the selected voxels only, instead of 
+                                     to the whole volume beforehand (default is None).
 
     Returns:
-    list: A list of computed features for all subcubes in the form of nested lists. 
-          Each inner list contains [sample, contrast_adjustment, division, subcube_index, features...].
+    dict: A columnar feature table. 'sample', 'contrast_adjustment' and 'division' are stored 
+          once as metadata, 'subcube' is an int32 array of subcube indexes and each computed 
+          feature is a float64 array with one value per subcube. In approximate mode only 
+          APPROXIMATE_FEATURES are computed and 'jackknife' maps each feature to a float64 
+          array of shape (n_replicates, subcubes) with the leave-one-group-out values.
     """
+    from image_preprocessing_utils import load_and_preprocess_image, adjust_contrast
+
     (sample, contrast_adjustment, division), im = dictionary_items
+    if not isinstance(im, np.ndarray):
+        im = load_and_preprocess_image((None, im), adjust=contrast_values is None)[1]
+    adjust = contrast_values is not None and contrast_adjustment
     
     z, x, y = im.shape
     segment_size = min(x, y) // division
     divisions_z = z // segment_size
-    statistics = []
+    approximate = sample_fraction is not None
+    feature_operations = get_feature_operations()
+    supported = APPROXIMATE_FEATURES if approximate else feature_operations
+    features = [feature for feature in feature_list if feature in supported]
+    n_subcubes = divisions_z * division ** 2
+    values = np.empty((len(features), n_subcubes), dtype=np.float64)
+    if approximate:
+        jackknife = np.empty((len(features), n_replicates, n_subcubes), dtype=np.float64)
+        rng = np.random.default_rng(None if seed is None else [seed, division, int(contrast_adjustment)])
 
     for i in range(divisions_z):
         for j in range(division):
             for k in range(division):
-                part = im[i * segment_size:(i + 1) * segment_size, 
+                cube = im[i * segment_size:(i + 1) * segment_size, 
                           j * segment_size:(j + 1) * segment_size, 
-                          k * segment_size:(k + 1) * segment_size].flatten()
+                          k * segment_size:(k + 1) * segment_size]
                 subcube_index = i * (division ** 2) + j * division + k
-                                
-                stats = [subcube_index]
-
-                feature_operations = {
-                    'mean': lambda part: np.mean(part),
-                    'std': lambda part: np.std(part),
-                    'min': lambda part: np.min(part),
-                    'max': lambda part: np.max(part),
-                    'skewness': lambda part: skew(part),
-                    'kurtosis': lambda part: kurtosis(part),
-                    'variation coefficient': lambda part: variation(part),
-                    'median': lambda part: np.median(part)
-                }
-
-                for feature in feature_list:
-                    if feature in feature_operations:
-                        stats.append(feature_operations[feature](part))
-                
-                statistics.append(stats)
-                
-    rows = []
-    for stats in statistics:
-        rows.append([sample, contrast_adjustment, division] + stats)
-        
-    return rows
+
+                if approximate:
+                    indices, groups = subsample_indices(cube.shape, sample_fraction, sampling, n_replicates, rng)
+                    part = cube[indices].ravel().astype(np.float64)
+                    if adjust:
+                        part = adjust_contrast(part, *contrast_values)
+                    # power sums per group, around the subsample mean to limit cancellation
+                    shift = part.mean()
+                    centered = part - shift
+                    group_sums = np.stack([
+                        np.bincount(groups, weights=centered ** p if p else None, minlength=n_replicates)
+                        for p in range(5)
+                    ], axis=-1)
+                    total_sums = group_sums.sum(axis=0)
+                    point = moment_features(total_sums, shift)
+                    leave_one_out = moment_features(total_sums - group_sums, shift)
+                    for f, feature in enumerate(features):
+                        values[f, subcube_index] = point[feature]
+                        jackknife[f, :, subcube_index] = leave_one_out[feature]
+                else:
+                    part = cube.flatten()
+                    if adjust:
+                        part = adjust_contrast(part, *contrast_values)
+                    for f, feature in enumerate(features):
+                        values[f, subcube_index] = feature_operations[feature](part)
+
+    table = {
+        'sample': sample,
+        'contrast_adjustment': contrast_adjustment,
+        'division': division,
+        'subcube': np.arange(n_subcubes, dtype=np.int32)
+    }
+    for f, feature in enumerate(features):
+        table[feature] = values[f]
+    if approximate:
+        table['jackknife'] = {feature: jackknife[f] for f, feature in enumerate(features)}
+
+    return table
+
+def feature_table_to_dataframe(table):
+    """
+    Converts a columnar feature table into a DataFrame in the features CSV layout.
+
+    Parameters:
+    table (dict): Feature table as returned by compute_image_statistics.
+
+    Returns:
+    pd.DataFrame: A DataFrame with one row per subcube. Metadata values are broadcast 
+                  to every row and jackknife values are left out.
+    """
+    import pandas as pd
+
+    return pd.DataFrame({key: value for key, value in table.items() if key != 'jackknife'})
+
+def iter_feature_columns(results, feature_list):
+    """
+    Yields the feature columns of each feature table, ready to be sent to entropy tasks.
+
+    Subcubes with any missing feature value are discarded, matching the row-wise 
+    dropna previously applied to the features DataFrame. Tables from the approximate 
+    mode also yield one leave-one-group-out column per jackknife replicate.
+
+    Parameters:
+    results (list of dict): Feature tables as returned by compute_image_statistics.
+    feature_list (list of str): List of feature names to yield.
+
+    Yields:
+    tuple: (contrast_adjustment, division, feature, replicate, values), where replicate is 
+           None for the point estimate and values is a 1D numpy array.
+    """
+    for table in results:
+        features = [feature for feature in feature_list if feature in table]
+        valid = np.ones(len(table['subcube']), dtype=bool)
+        jackknife = table.get('jackknife', {})
+        for feature in features:
+            valid &= ~np.isnan(table[feature])
+            if feature in jackknife:
+                valid &= ~np.isnan(jackknife[feature]).any(axis=0)
+        for feature in features:
+            yield table['contrast_adjustment'], table['division'], feature, None, table[feature][valid]
+        for feature in features:
+            for replicate, replicate_values in enumerate(jackknife.get(feature, [])):
+                yield table['contrast_adjustment'], table['division'], feature, replicate, replicate_values[valid]
 
 def export_features(results, sample, feature_list):
     """
     Exports the computed statistical features to a CSV file and returns the DataFrame.
 
     Parameters:
-    results (list): A nested list containing computed feature values for each subcube.
-                    Each inner list should have the structure:
-                    [sample, contrast_adjustment, division, subcube_index, features...].
+    results (list of dict): Feature tables as returned by compute_image_statistics, one 
+                            per (contrast_adjustment, division) combination.
     sample (str): Name of the sample for which features were computed.
     feature_list (list of str): List of feature names to be used as column headers in the CSV file.
 
@@ -100,14 +306,18 @@ def export_features(results, sample, feature_list):
     pd.DataFrame: A DataFrame containing the computed features, with columns:
                   ['sample', 'contrast_adjustment', 'division', 'subcube'] + feature_list.
     """
-    # Flatten the nested list of results
-    flattened_results = [item for sublist in results for item in sublist]
+    import pandas as pd
+
+    # Build one DataFrame per feature table and stack them
+    df_sample = pd.concat([feature_table_to_dataframe(table) for table in results], ignore_index=True)
 
-    # Create a DataFrame from the flattened results
-    df_sample = pd.DataFrame(
-        flattened_results, 
-        columns=['sample', 'contrast_adjustment', 'division', 'subcube'] + feature_list
-    )
-    # Return the DataFrame
-    return df_sample
+    # min and max of unadjusted volumes are integer voxel values, so they are written as 
+    # integers like before; contrast-adjusted values are real numbers and stay float
+    for feature in ['min', 'max']:
+        if feature in df_sample.columns:
+            column = df_sample[feature].to_numpy()
+            if np.all(np.isfinite(column)) and np.all(column == np.round(column)):
+                df_sample[feature] = column.astype(np.int64)
 
+    # Return the DataFrame in the features CSV column order
+    return df_sample[['sample', 'contrast_adjustment', 'division', 'subcube'] + feature_list]
@@ -3,10 +3,8 @@
 import os
 import pandas as pd
 import numpy as np
-import xarray as xr
-import cv2
-from shapely.geometry import box
 import sys
+import hashlib
 
 def check_image_dtype(filepath):
     """
@@ -18,6 +16,8 @@ def check_image_dtype(filepath):
     Returns:
     None
     """
+    import xarray as xr
+
     try:
         with xr.open_dataset(filepath) as db:
             im = db['microtom']
@@ -28,12 +28,34 @@ def check_image_dtype(filepath):
         print(f'Error opening file: {e}', flush=True)
         sys.exit(1)
         
-def load_and_preprocess_image(data):
+def adjust_contrast(im, voidmean, rockmedian):
+    """
+    Applies the contrast adjustment to image values, mapping voidmean to 0 and rockmedian 
+    to 32768. The adjustment is pointwise, so it can also be applied to a voxel subsample.
+
+    Parameters:
+    im (np.ndarray): Image or voxel values.
+    voidmean (float): Mean value of the void region.
+    rockmedian (float): Median value of the rock region.
+
+    Returns:
+    np.ndarray: Adjusted float64 values, clipped to the uint16 range.
+    """
+    im = im - float(voidmean)
+    im = im * 32768 / float(rockmedian)
+    return np.clip(im, 0, 65535)
+
+def load_and_preprocess_image(data, adjust=True):
     """
     Loads and preprocesses a microtom image based on given parameters.
+
+    When the row has a 'cache_path', the cropped volume is memory-mapped from the 
+    volume cache instead of being read from the NetCDF file.
     
     Parameters:
     data (tuple): Tuple containing index and row of DataFrame with sample and adjustment info.
+    adjust (bool): Whether to apply the contrast adjustment requested by the row. When False 
+                   the raw uint16 volume is returned (default is True).
     
     Returns:
     tuple: Contains sample name, processed image array, and contrast_adjustment flag.
@@ -43,15 +65,24 @@ def load_and_preprocess_image(data):
     nc_path = row['dataset']
     contrast_adjustment = row['contrast_adjustment']
 
+    if isinstance(row.get('cache_path'), str):
+        im = np.load(row['cache_path'], mmap_mode='r')
+
+        if contrast_adjustment and adjust:
+            im = adjust_contrast(im, row['voidmean'], row['rockmedian'])
+
+        return sample, im, contrast_adjustment
+
+    # imported after the cached-volume return, so feature workers mapping cached volumes skip it
+    import xarray as xr
+
     if os.path.exists(nc_path):
         with xr.open_dataset(nc_path) as db:
             im = db['microtom'][int(row['z_ini']):int(row['z_fin']), int(row['x_ini']):int(row['x_fin']), int(row['y_ini']):int(row['y_fin'])]
             im = np.array(im)
 
-            if contrast_adjustment:
-                im = im - float(row['voidmean'])
-                im = im * 32768 / float(row['rockmedian'])
-                im = np.clip(im, 0, 65535)
+            if contrast_adjustment and adjust:
+                im = adjust_contrast(im, row['voidmean'], row['rockmedian'])
 
         return sample, im, contrast_adjustment
 
@@ -90,6 +121,10 @@ def get_rectangle_bounds(filename, z_ini, z_fin, slices_for_bound_detectation=50
     Returns:
     tuple: Contains filename and calculated bounds.
     """
+    import xarray as xr
+    import cv2
+    from shapely.geometry import box
+
     plug_rectangles = []
     with xr.open_dataset(filename) as db:
         middle_point = db.microtom.values.shape[0] // 2
@@ -206,6 +241,8 @@ def get_info(filename, z_i, z_f):
     Returns:
     list: List of tuples with filename and selected positions.
     """
+    import xarray as xr
+
     with xr.open_dataset(filename) as db:
         im = np.array(db['microtom'])
     selection = np.random.choice(range(int(z_i), int(z_f) + 1), 100, replace=False)
@@ -225,7 +262,9 @@ def get_contrast_adjustments_values(info):
         - voidmean (float): The mean value of the void areas in the image after adjustment.
         - rockmedian (float): The median value of the rock areas in the image after adjustment.
     """
-    
+    import xarray as xr
+    import cv2
+
     filename, position = info
     with xr.open_dataset(filename) as db:
         im = np.array(db['microtom'][position])
@@ -251,3 +290,20 @@ def get_contrast_adjustments_values(info):
     rockmedian = np.median(im[~thresh])
 
     return filename, voidmean, rockmedian
+
+def file_content_hash(filepath, chunk_size=1 << 24):
+    """
+    Computes the SHA-256 hash of a file's content, reading it in chunks.
+
+    Parameters:
+    filepath (str): Path to the file.
+    chunk_size (int): Number of bytes read at a time (default is 16 MiB).
+
+    Returns:
+    str: Hexadecimal digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -83,3 +83,20 @@ def int_or_none(value):
         return int(value)
     except (ValueError, AttributeError):
         return None
+
+def float_or_none(value):
+    """
+    Attempts to convert the given value to a float. 
+
+    If the conversion fails due to a ValueError or AttributeError, it returns None.
+
+    Parameters:
+    value (any): The input value to be converted to a float.
+
+    Returns:
+    float or None: The converted float if successful, otherwise None.
+    """
+    try:
+        return float(value)
+    except (ValueError, AttributeError):
+        return None
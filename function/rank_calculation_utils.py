@@ -3,8 +3,12 @@
 import numpy as np
 import pandas as pd
 import os
-from sklearn.preprocessing import StandardScaler
-from sklearn.neighbors import KernelDensity
+
+# file with the reference feature grid statistics, written by the corpus builder
+SCALER_STATS_FILE = 'scaler_stats.csv'
+
+# features whose entropy is taken from value counts, so it does not depend on the scaling
+DISCRETE_FEATURES = ['max', 'min', 'median']
 
 def entropy(values):
     """
@@ -18,10 +22,11 @@ def entropy(values):
            it uses Shannon entropy on value counts. For continuous features, 
            it estimates entropy using Kernel Density Estimation (KDE) and numerical integration.
     """
+    from sklearn.neighbors import KernelDensity
+
     feature_name = values.name
-    discrete_features = ['max', 'min', 'median']
     
-    if feature_name in discrete_features:
+    if feature_name in DISCRETE_FEATURES:
         value_counts = values.value_counts(normalize=True)
         entropy = -np.sum(value_counts * np.log2(value_counts))
     else:
@@ -63,38 +68,105 @@ def calculate_sample_entropy(df, adjustment, division, feature, sample):
 
     return entropy_results
 
-def process_adjustment_division_feature(combination, features_folder, df_sample_features, sample, scale_features=True):
+def compute_scaler_stats(df_features_all, adjustment, division, feature_list):
+    """
+    Computes the scaling statistics of a reference feature grid, equivalent to fitting 
+    a StandardScaler on each feature column.
+
+    Parameters:
+    df_features_all (pd.DataFrame): Reference feature grid for one contrast adjustment and division.
+    adjustment (bool): Contrast adjustment flag of the grid.
+    division (int): Division value of the grid.
+    feature_list (list of str): List of feature names.
+
+    Returns:
+    dict: Dictionary mapping (contrast_adjustment, division, feature) to a (mean, scale) tuple.
+    """
+    scaler_stats = {}
+    for feature in feature_list:
+        values = df_features_all[feature].values.astype(np.float64)
+        scale = np.nanstd(values)
+        scaler_stats[(adjustment, division, feature)] = (np.nanmean(values), scale if scale != 0 else 1.0)
+    return scaler_stats
+
+def load_reference_scaler_stats(features_folder, contrast_adjustment_options, division_list, feature_list):
+    """
+    Loads the scaling statistics of the reference feature grids.
+
+    Statistics are taken from the scaler_stats.csv file written by the corpus builder 
+    when it is up to date with the grid files, and computed from the grids otherwise.
+
+    Parameters:
+    features_folder (str): Path to the folder containing all feature grids.
+    contrast_adjustment_options (list of bool): List of contrast adjustment flags.
+    division_list (list of int): List of division values.
+    feature_list (list of str): List of feature names.
+
+    Returns:
+    dict: Dictionary mapping (contrast_adjustment, division, feature) to a (mean, scale) tuple.
+    """
+    stats_path = os.path.join(features_folder, SCALER_STATS_FILE)
+    saved_stats = {}
+    if os.path.exists(stats_path):
+        df_stats = pd.read_csv(stats_path)
+        saved_stats = {
+            (adjustment, division, feature): (mean, scale)
+            for adjustment, division, feature, mean, scale in zip(
+                df_stats['contrast_adjustment'], df_stats['division'], df_stats['feature'], df_stats['mean'], df_stats['scale']
+            )
+        }
+
+    scaler_stats = {}
+    for adjustment in contrast_adjustment_options:
+        adjustment_folder = 'ajuste_surmas' if adjustment else 'sem_ajuste'
+        for division in division_list:
+            grid_path = os.path.join(features_folder, f'grid_features_{adjustment_folder}_{division}.csv')
+            keys = [(adjustment, division, feature) for feature in feature_list]
+            if all(key in saved_stats for key in keys) and os.path.getmtime(stats_path) >= os.path.getmtime(grid_path):
+                scaler_stats.update({key: saved_stats[key] for key in keys})
+            else:
+                df_features_all = pd.read_csv(grid_path, usecols=feature_list)
+                scaler_stats.update(compute_scaler_stats(df_features_all, adjustment, division, feature_list))
+    return scaler_stats
+
+def process_adjustment_division_feature(combination, features_folder, sample, scale_features=True, scaler_stats=None):
     """
     Processes a combination of contrast adjustment, division, and feature to compute entropy.
 
     Parameters:
-    combination (tuple): Tuple containing adjustment type, division factor, and feature name.
+    combination (tuple): Tuple containing adjustment type, division factor, feature name, 
+                         replicate index (None outside the approximate mode) and the sample's 
+                         feature values (1D numpy array) for that combination.
     features_folder (str): Path to the folder containing all feature grids.
-    data_entropy (str): Path to the file with pre-computed entropy data.
-    output_folder (str): Path to the folder for output results.
     sample (str): Name of the sample being processed.
     scale_features (bool): Whether to apply feature scaling (default is True).
+    scaler_stats (dict or None): Precomputed reference statistics, as returned by 
+                                 load_reference_scaler_stats. When None, the reference grid 
+                                 is read from features_folder (default is None).
 
     Returns:
     list: A list of entropy results for the given combination.
     """
-    adjustment, division, feature = combination
+    adjustment, division, feature, replicate, values = combination
 
-    df_sample_features = df_sample_features.loc[
-        (df_sample_features['division'] == division) & 
-        (df_sample_features['contrast_adjustment'] == adjustment)
-    ]
-    df_sample_features = df_sample_features.dropna()
-
-    adjustment_folder = 'ajuste_surmas' if adjustment else 'sem_ajuste'
-    df_features_all = pd.read_csv(os.path.join(features_folder, f'grid_features_{adjustment_folder}_{division}.csv'))
- 
     if scale_features:
-        scaler = StandardScaler()
-        scaler.fit(df_features_all[feature].values.reshape(-1, 1))
-        df_sample_features[feature] = scaler.transform(df_sample_features[feature].values.reshape(-1, 1))
+        if scaler_stats is not None:
+            mean, scale = scaler_stats[(adjustment, division, feature)]
+            values = (values - mean) / scale
+        else:
+            from sklearn.preprocessing import StandardScaler
+
+            adjustment_folder = 'ajuste_surmas' if adjustment else 'sem_ajuste'
+            df_features_all = pd.read_csv(os.path.join(features_folder, f'grid_features_{adjustment_folder}_{division}.csv'), usecols=[feature])
+            scaler = StandardScaler()
+            scaler.fit(df_features_all[feature].values.reshape(-1, 1))
+            values = scaler.transform(values.reshape(-1, 1)).ravel()
 
+    df_sample_features = pd.DataFrame({feature: values})
     entropy = calculate_sample_entropy(df_sample_features, adjustment, division, feature, sample)
+    if replicate is not None:
+        for result in entropy:
+            result['replicate'] = replicate
     return entropy
 
 def generate_entropy_df(results):
@@ -107,13 +179,51 @@ def generate_entropy_df(results):
 
     Returns:
     pd.DataFrame: A DataFrame structured to show entropy results, pivoted by 
-                  sample, division, and contrast adjustment.
+                  sample, division, and contrast adjustment (and replicate, when present).
     """
     flattened_results = [item for sublist in results for item in sublist]
     results_df = pd.DataFrame(flattened_results)
-    df_entropy_sample = results_df.pivot_table(index=['sample', 'division', 'contrast_adjustment']).reset_index()
+    index = ['sample', 'division', 'contrast_adjustment']
+    if 'replicate' in results_df.columns:
+        index.append('replicate')
+    df_entropy_sample = results_df.pivot_table(index=index).reset_index()
     return df_entropy_sample
 
+def summarize_entropy_jackknife(entropy_sample, entropy_replicates, feature_list, confidence=0.95):
+    """
+    Adds group jackknife confidence intervals to the entropies of the approximate mode.
+
+    Each replicate entropy is computed from the subsample without one of its n disjoint 
+    groups. The standard error is sqrt((n - 1) / n * sum((replicate - mean) ** 2)) and the 
+    interval is the point entropy plus or minus the Student t quantile with n - 1 degrees 
+    of freedom times the standard error.
+
+    Parameters:
+    entropy_sample (pd.DataFrame): Entropy DataFrame of the whole subsample, as returned 
+                                   by generate_entropy_df.
+    entropy_replicates (pd.DataFrame): Entropy DataFrame of the jackknife replicates, with 
+                                       a 'replicate' column.
+    feature_list (list of str): List of feature names to summarize.
+    confidence (float): Confidence level of the interval (default is 0.95).
+
+    Returns:
+    pd.DataFrame: entropy_sample with '{feature}_low' and '{feature}_high' interval bounds.
+    """
+    from scipy.stats import t
+
+    index = ['sample', 'division', 'contrast_adjustment']
+    grouped = entropy_replicates.groupby(index)[feature_list]
+    n_replicates = grouped.size()
+    deviations = entropy_replicates[feature_list] - grouped.transform('mean')
+    squared_sum = (deviations ** 2).groupby([entropy_replicates[column] for column in index]).sum()
+    standard_error = np.sqrt(squared_sum.mul((n_replicates - 1) / n_replicates, axis=0))
+    margin = standard_error.mul(t.ppf(1 - (1 - confidence) / 2, n_replicates - 1), axis=0)
+
+    summary = entropy_sample.set_index(index)
+    low = (summary[feature_list] - margin).add_suffix('_low')
+    high = (summary[feature_list] + margin).add_suffix('_high')
+    return pd.concat([summary, low, high], axis=1).reset_index()
+
 def calculate_sample_rank(entropy_dataframe, entropy_sample, feature_list, output_folder):
     """
     Adds a new sample's entropy data to the rank DataFrame and recalculates feature ranks.
@@ -154,3 +264,60 @@ def calculate_sample_rank(entropy_dataframe, entropy_sample, feature_list, outpu
 
     entropy_rank_sample_df = entropy_rank_dataframe[entropy_rank_dataframe['sample'] == sample_name]
     return entropy_rank_sample_df
+
+def calculate_sample_rank_interval(entropy_dataframe, entropy_summary, feature_list, output_folder):
+    """
+    Calculates the sample rank of the approximate mode together with a confidence 
+    interval propagated from the entropy interval.
+
+    The rank of an entropy value among the reference samples does not decrease as the 
+    value grows, so the rank interval bounds are the ranks of the entropy interval bounds.
+
+    Parameters:
+    entropy_dataframe (pd.DataFrame): DataFrame containing existing entropy values and ranks.
+    entropy_summary (pd.DataFrame): Entropy DataFrame of the new sample with '{feature}_low' 
+                                    and '{feature}_high' columns, as returned by 
+                                    summarize_entropy_jackknife.
+    feature_list (list of str): List of feature names to be ranked.
+    output_folder (str): Path to the folder where the updated rank DataFrame will be saved.
+
+    Returns:
+    pd.DataFrame: DataFrame with the ranks for the new sample, plus '{feature}_rank_low' and 
+                  '{feature}_rank_high' interval bounds.
+    """
+    index = ['sample', 'division', 'contrast_adjustment']
+    rank_df = calculate_sample_rank(entropy_dataframe, entropy_summary[index + feature_list], feature_list, output_folder)
+
+    for bound in ['low', 'high']:
+        entropy_bound = entropy_summary[index + [f'{feature}_{bound}' for feature in feature_list]]
+        entropy_bound = entropy_bound.rename(columns={f'{feature}_{bound}': feature for feature in feature_list})
+        rank_bound = calculate_sample_rank(entropy_dataframe, entropy_bound, feature_list, output_folder)
+        rank_bound = rank_bound.rename(columns={f'{feature}_rank': f'{feature}_rank_{bound}' for feature in feature_list})
+        rank_df = rank_df.merge(rank_bound, on=index, how='left')
+
+    return rank_df
+
+def max_rank_change(previous_rank, current_rank, feature_list):
+    """
+    Computes the largest rank change of a sample between two successive divisions.
+
+    Parameters:
+    previous_rank (pd.DataFrame): Rank DataFrame of the sample for the previous division.
+    current_rank (pd.DataFrame): Rank DataFrame of the sample for the current division.
+    feature_list (list of str): List of ranked feature names.
+
+    Returns:
+    float: Maximum absolute difference, in percentile points, between the '{feature}_rank' 
+           values of both divisions, matched by contrast adjustment.
+    """
+    rank_columns = [f'{feature}_rank' for feature in feature_list]
+    merged = pd.merge(
+        previous_rank[['contrast_adjustment'] + rank_columns],
+        current_rank[['contrast_adjustment'] + rank_columns],
+        on='contrast_adjustment', suffixes=('_previous', '_current')
+    )
+    changes = [
+        (merged[f'{column}_current'] - merged[f'{column}_previous']).abs().max()
+        for column in rank_columns
+    ]
+    return float(np.nanmax(changes))
@@ -0,0 +1,404 @@
+# rank_service.py
+
+import os
+import json
+import queue
+import threading
+import uuid
+import time
+import argparse
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import request as urllib_request
+from urllib.error import HTTPError
+import pandas as pd
+
+from parser_utils import list_of_bools, list_of_ints, list_of_strings
+from rank_calculation_utils import load_reference_scaler_stats
+from run_sample import heterogeneity_rank, create_worker_pool
+from resource_planner import available_cpus
+
+# heterogeneity_rank options that can be set per job
+JOB_OPTIONS = [
+    'division_list', 'contrast_adjustment_options', 'feature_list', 'z_ini', 'z_fin',
+    'sample_fraction', 'sampling', 'n_replicates', 'confidence', 'seed',
+    'progressive', 'rank_stability_tol', 'rank_stability_patience', 'cache_folder', 'cache_budget_gb',
+    'cache_grace_seconds', 'memory_fraction'
+]
+
+class RankService:
+    """
+    Long-running ranking service that keeps the reference entropy table, the reference
+    scaler statistics and the worker pool warm across samples.
+
+    Submitted samples are queued and processed one at a time by a background thread,
+    so the latency of each sample includes only its own work.
+    """
+
+    def __init__(self, features_folder, output_folder, data_entropy_path, division_list, contrast_adjustment_options, feature_list, processes=None):
+        self.features_folder = features_folder
+        self.output_folder = output_folder
+        self.data_entropy_path = data_entropy_path
+        self.defaults = {
+            'division_list': division_list,
+            'contrast_adjustment_options': contrast_adjustment_options,
+            'feature_list': feature_list
+        }
+        self.processes = processes or available_cpus()
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.reference_lock = threading.Lock()
+        self.job_queue = queue.Queue()
+        self.pool = None
+        self.worker = None
+
+    def load_reference(self):
+        """
+        Loads, or reloads, the reference entropy table and the reference scaler statistics
+        for the default divisions, contrast adjustments and features.
+
+        Returns:
+        None
+        """
+        load_start = time.time()
+        data_entropy = pd.read_csv(self.data_entropy_path)
+        scaler_stats = load_reference_scaler_stats(
+            self.features_folder, self.defaults['contrast_adjustment_options'],
+            self.defaults['division_list'], self.defaults['feature_list']
+        )
+        with self.reference_lock:
+            self.data_entropy = data_entropy
+            self.scaler_stats = scaler_stats
+        load_end = time.time()
+        print(f'Reference data loaded. Time elapsed (seconds): {load_end - load_start}', flush=True)
+
+    def get_scaler_stats(self, contrast_adjustment_options, division_list, feature_list):
+        """
+        Returns the reference scaler statistics for the requested combinations, loading
+        and caching any combination not loaded yet.
+
+        Parameters:
+        contrast_adjustment_options (list of bool): List of contrast adjustment flags.
+        division_list (list of int): List of division values.
+        feature_list (list of str): List of feature names.
+
+        Returns:
+        dict: Dictionary mapping (contrast_adjustment, division, feature) to a (mean, scale) tuple.
+        """
+        with self.reference_lock:
+            missing = [
+                (adjustment, division) for adjustment in contrast_adjustment_options for division in division_list
+                if any((adjustment, division, feature) not in self.scaler_stats for feature in feature_list)
+            ]
+            for adjustment, division in missing:
+                self.scaler_stats.update(load_reference_scaler_stats(self.features_folder, [adjustment], [division], feature_list))
+            return self.scaler_stats
+
+    def start(self):
+        """
+        Loads the reference data, starts the worker pool and the job processing thread.
+
+        Returns:
+        None
+        """
+        self.load_reference()
+        pool_start = time.time()
+        self.pool = create_worker_pool(self.processes)
+        pool_end = time.time()
+        print(f'Worker pool with {self.processes} processes started. Time elapsed (seconds): {pool_end - pool_start}', flush=True)
+        self.worker = threading.Thread(target=self.process_jobs, daemon=True)
+        self.worker.start()
+
+    def stop(self):
+        """
+        Stops the job processing thread after the current job and closes the worker pool.
+
+        Returns:
+        None
+        """
+        self.job_queue.put(None)
+        self.worker.join()
+        self.pool.close()
+        self.pool.join()
+
+    def submit(self, sample_path, **options):
+        """
+        Queues a sample for ranking.
+
+        Parameters:
+        sample_path (str): Path to the .nc sample file.
+        options: heterogeneity_rank options overriding the service defaults (see JOB_OPTIONS).
+
+        Returns:
+        str: Identifier of the submitted job.
+        """
+        unknown = set(options) - set(JOB_OPTIONS)
+        if unknown:
+            raise ValueError(f'Unknown job options: {sorted(unknown)}')
+        job_id = uuid.uuid4().hex
+        with self.jobs_lock:
+            self.jobs[job_id] = {
+                'job_id': job_id,
+                'sample_path': sample_path,
+                'options': options,
+                'status': 'queued',
+                'submitted': datetime.now().isoformat(),
+                'started': None,
+                'finished': None,
+                'error': None,
+                'partial': [],
+                'result': None
+            }
+        self.job_queue.put(job_id)
+        return job_id
+
+    def status(self, job_id):
+        """
+        Returns the status of a job, without its rank results.
+
+        Parameters:
+        job_id (str): Identifier of the job.
+
+        Returns:
+        dict or None: Job status, or None if the job does not exist.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            status = {key: value for key, value in job.items() if key not in ['partial', 'result']}
+            status['divisions_ranked'] = len(job['partial'])
+            return status
+
+    def result(self, job_id):
+        """
+        Returns the rank results of a job. While a job is running, the divisions
+        ranked so far are returned.
+
+        Parameters:
+        job_id (str): Identifier of the job.
+
+        Returns:
+        dict or None: Job status and rank rows as a list of records, or None if the job does not exist.
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            rows = job['result'] if job['result'] is not None else [row for rows in job['partial'] for row in rows]
+            return {'job_id': job_id, 'status': job['status'], 'rank': rows}
+
+    def process_jobs(self):
+        """
+        Processes queued jobs until stop is requested.
+
+        Returns:
+        None
+        """
+        while True:
+            job_id = self.job_queue.get()
+            if job_id is None:
+                break
+            self.run_job(job_id)
+
+    def run_job(self, job_id):
+        """
+        Runs heterogeneity_rank for a queued job using the warm reference data and pool.
+
+        Parameters:
+        job_id (str): Identifier of the job.
+
+        Returns:
+        None
+        """
+        with self.jobs_lock:
+            job = self.jobs[job_id]
+            job['status'] = 'running'
+            job['started'] = datetime.now().isoformat()
+
+        def on_division_ranked(divisions, rank_df):
+            with self.jobs_lock:
+                job['partial'].append(json.loads(rank_df.to_json(orient='records')))
+
+        options = dict(self.defaults, **job['options'])
+        options.setdefault('z_ini', None)
+        options.setdefault('z_fin', None)
+        try:
+            with self.reference_lock:
+                data_entropy = self.data_entropy
+            scaler_stats = self.get_scaler_stats(options['contrast_adjustment_options'], options['division_list'], options['feature_list'])
+            rank_df = heterogeneity_rank(
+                sample_path=job['sample_path'],
+                features_folder=self.features_folder,
+                output_folder=self.output_folder,
+                data_rank_path=None,
+                data_entropy_path=self.data_entropy_path,
+                on_division_ranked=on_division_ranked,
+                data_entropy=data_entropy,
+                scaler_stats=scaler_stats,
+                pool=self.pool,
+                **options
+            )
+            with self.jobs_lock:
+                job['result'] = json.loads(rank_df.to_json(orient='records'))
+                job['status'] = 'done'
+        # heterogeneity_rank stops invalid samples with sys.exit, which must not stop the service
+        except (Exception, SystemExit) as e:
+            print(f'Job {job_id} failed: {e!r}', flush=True)
+            with self.jobs_lock:
+                job['error'] = repr(e)
+                job['status'] = 'failed'
+        finally:
+            with self.jobs_lock:
+                job['finished'] = datetime.now().isoformat()
+
+def make_handler(service):
+    """
+    Creates the HTTP request handler class bound to a RankService.
+
+    Endpoints:
+    POST /jobs               {"sample_path": ..., options...} -> {"job_id": ...}
+    GET  /jobs               -> list of job statuses
+    GET  /jobs/<id>          -> job status
+    GET  /jobs/<id>/result   -> job status and rank rows
+    POST /reload             -> reloads the reference entropy table and scaler statistics
+
+    Parameters:
+    service (RankService): Service handling the requests.
+
+    Returns:
+    type: BaseHTTPRequestHandler subclass.
+    """
+    class RankRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, code, body):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            parts = [part for part in self.path.split('/') if part]
+            if parts == ['jobs']:
+                with service.jobs_lock:
+                    job_ids = list(service.jobs)
+                self.send_json(200, [service.status(job_id) for job_id in job_ids])
+            elif len(parts) == 2 and parts[0] == 'jobs':
+                status = service.status(parts[1])
+                if status is None:
+                    self.send_json(404, {'error': 'job not found'})
+                else:
+                    self.send_json(200, status)
+            elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'result':
+                result = service.result(parts[1])
+                if result is None:
+                    self.send_json(404, {'error': 'job not found'})
+                else:
+                    self.send_json(200, result)
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def do_POST(self):
+            parts = [part for part in self.path.split('/') if part]
+            if parts == ['jobs']:
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                    sample_path = body.pop('sample_path')
+                    job_id = service.submit(sample_path, **body)
+                except (ValueError, KeyError) as e:
+                    self.send_json(400, {'error': repr(e)})
+                    return
+                self.send_json(202, {'job_id': job_id})
+            elif parts == ['reload']:
+                service.load_reference()
+                self.send_json(200, {'status': 'reloaded'})
+            else:
+                self.send_json(404, {'error': 'not found'})
+
+        def log_message(self, format, *args):
+            print(f'{self.address_string()} - {format % args}', flush=True)
+
+    return RankRequestHandler
+
+class RankServiceClient:
+    """
+    Minimal client for the ranking service HTTP API.
+    """
+
+    def __init__(self, url='http://127.0.0.1:8765'):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib_request.Request(f'{self.url}{path}', data=data, method=method, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib_request.urlopen(req) as response:
+                return json.loads(response.read())
+        except HTTPError as e:
+            return json.loads(e.read())
+
+    def submit(self, sample_path, **options):
+        return self.request('POST', '/jobs', dict(options, sample_path=sample_path))['job_id']
+
+    def status(self, job_id):
+        return self.request('GET', f'/jobs/{job_id}')
+
+    def result(self, job_id):
+        return self.request('GET', f'/jobs/{job_id}/result')
+
+    def reload(self):
+        return self.request('POST', '/reload')
+
+    def wait(self, job_id, poll_interval=5, timeout=None):
+        """
+        Waits until a job is finished and returns its result.
+
+        Parameters:
+        job_id (str): Identifier of the job.
+        poll_interval (float): Seconds between status requests (default is 5).
+        timeout (float or None): Maximum number of seconds to wait (default is None, no limit).
+
+        Returns:
+        dict: Job status and rank rows.
+        """
+        wait_start = time.time()
+        while self.status(job_id)['status'] in ['queued', 'running']:
+            if timeout is not None and time.time() - wait_start > timeout:
+                raise TimeoutError(f'Job {job_id} not finished after {timeout} seconds')
+            time.sleep(poll_interval)
+        return self.result(job_id)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-features_folder", type=str, required=True)
+    parser.add_argument("-output_folder", type=str, required=True)
+    parser.add_argument("-data_entropy_path", type=str, required=True)
+    parser.add_argument("-division_list", type=list_of_ints, default='2,3,4,5,6,7,8,9,10')
+    parser.add_argument("-contrast_adjustment_options", type=list_of_bools, default='True, False')
+    parser.add_argument("-feature_list", type=list_of_strings, default='mean,std,min,max,skewness,kurtosis,"variation coefficient",median')
+    parser.add_argument("-processes", type=int, default=None)
+    parser.add_argument("-host", type=str, default='127.0.0.1')
+    parser.add_argument("-port", type=int, default=8765)
+
+    args = parser.parse_args()
+    os.makedirs(args.output_folder, exist_ok=True)
+    service = RankService(features_folder = args.features_folder,
+                          output_folder = args.output_folder,
+                          data_entropy_path = args.data_entropy_path,
+                          division_list = args.division_list,
+                          contrast_adjustment_options = args.contrast_adjustment_options,
+                          feature_list = args.feature_list,
+                          processes = args.processes)
+    service.start()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    print(f'Rank service listening on http://{args.host}:{args.port}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
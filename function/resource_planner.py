@@ -0,0 +1,395 @@
+# resource_planner.py
+
+import os
+import math
+import threading
+from concurrent.futures import Future
+from multiprocessing import cpu_count
+
+# mount point of the cgroup hierarchies
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# memory used by an idle worker process with NumPy, SciPy, pandas and sklearn imported
+WORKER_BASELINE_BYTES = 300 * 1024 ** 2
+
+def read_int_file(path):
+    """
+    Reads a single integer from a file, as found in cgroup interface files.
+
+    Parameters:
+    path (str): Path to the file.
+
+    Returns:
+    int or None: The integer value, or None if the file does not exist or holds no limit.
+    """
+    try:
+        with open(path) as f:
+            value = f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+    if value == 'max':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+def cgroup_directories(controller):
+    """
+    Returns the cgroup directories that limit this process for a controller, from its own
+    cgroup up to the root of the hierarchy, as read from /proc/self/cgroup.
+
+    Parameters:
+    controller (str): cgroup v1 controller name, 'memory' or 'cpu'. The unified cgroup v2
+                      hierarchy is always included.
+
+    Returns:
+    list of tuples: (version, directory) for every existing directory, where version is 1 or 2.
+    """
+    try:
+        with open('/proc/self/cgroup') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+
+    directories = []
+    for line in lines:
+        parts = line.split(':', 2)
+        if len(parts) != 3:
+            continue
+        _, controllers, path = parts
+        if controllers == '':
+            # hybrid setups mount the unified hierarchy next to the v1 controllers
+            version, mounts = 2, [CGROUP_ROOT, os.path.join(CGROUP_ROOT, 'unified')]
+            marker = 'cgroup.controllers'
+        elif controller in controllers.split(','):
+            version, mounts = 1, [os.path.join(CGROUP_ROOT, controllers), os.path.join(CGROUP_ROOT, controller)]
+            marker = ''
+        else:
+            continue
+        mount = next((mount for mount in mounts if os.path.exists(os.path.join(mount, marker))), None)
+        if mount is None:
+            continue
+        # walk up the hierarchy; parts above the mounted subtree, as seen from a container, do not exist
+        components = [component for component in path.split('/') if component]
+        for depth in range(len(components), -1, -1):
+            directory = os.path.join(mount, *components[:depth])
+            if os.path.isdir(directory) and (version, directory) not in directories:
+                directories.append((version, directory))
+    return directories
+
+def available_memory_bytes():
+    """
+    Returns the memory available to this process, as the minimum of the system available
+    memory and the remaining room under the memory limit of its cgroup (v2 or v1) and of
+    every ancestor cgroup.
+
+    Returns:
+    int or None: Available memory in bytes, or None if it cannot be determined.
+    """
+    candidates = []
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    candidates.append(int(line.split()[1]) * 1024)
+                    break
+    except OSError:
+        pass
+
+    cgroup_files = {
+        2: ('memory.max', 'memory.current'),
+        1: ('memory.limit_in_bytes', 'memory.usage_in_bytes')
+    }
+    for version, directory in cgroup_directories('memory'):
+        limit_file, usage_file = cgroup_files[version]
+        limit = read_int_file(os.path.join(directory, limit_file))
+        # cgroup v1 reports a huge number when there is no limit
+        if limit is not None and limit < 1 << 60:
+            usage = read_int_file(os.path.join(directory, usage_file)) or 0
+            candidates.append(max(limit - usage, 0))
+
+    return min(candidates) if candidates else None
+
+def available_cpus():
+    """
+    Returns the number of CPUs usable by this process, considering CPU affinity and the
+    tightest CPU quota of its cgroup (v2 or v1) and of every ancestor cgroup.
+
+    Returns:
+    int: Number of usable CPUs.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = cpu_count()
+    for version, directory in cgroup_directories('cpu'):
+        if version == 2:
+            try:
+                with open(os.path.join(directory, 'cpu.max')) as f:
+                    quota, period = f.read().split()
+                quota, period = (None if quota == 'max' else int(quota)), int(period)
+            except (OSError, ValueError):
+                continue
+        else:
+            quota = read_int_file(os.path.join(directory, 'cpu.cfs_quota_us'))
+            period = read_int_file(os.path.join(directory, 'cpu.cfs_period_us'))
+        # cgroup v1 reports a quota of -1 when there is no limit
+        if quota is not None and quota > 0 and period:
+            cpus = min(cpus, max(1, math.ceil(quota / period)))
+    return cpus
+
+def entropy_task_bytes(n_values):
+    """
+    Estimates the memory used by one entropy task, without the worker baseline.
+
+    Parameters:
+    n_values (int): Number of feature values of the task.
+
+    Returns:
+    int: Estimated bytes for the feature column, its scaled copies and the KDE evaluation grid.
+    """
+    return n_values * 8 * 4 + 1000 * 8 * 4
+
+def estimate_stage_memory(crop_shape, contrast_adjustment_options, division_list, feature_list, sample_fraction=None, n_replicates=1, cached=False):
+    """
+    Estimates the peak memory used by one task of each pool stage.
+
+    Parameters:
+    crop_shape (tuple): Shape (z, x, y) of the cropped sample volume.
+    contrast_adjustment_options (list of bool): List of contrast adjustment flags.
+    division_list (list of int): List of division values.
+    feature_list (list of str): List of feature names.
+    sample_fraction (float or None): Voxel fraction of the approximate mode, or None.
+    n_replicates (int): Number of jackknife groups of the approximate mode.
+    cached (bool): Whether the raw volume is memory-mapped from the volume cache.
+
+    Returns:
+    dict: Estimated bytes per task for the 'loading', 'features' and 'entropy' stages, and
+          the bytes held by the parent process ('parent').
+    """
+    voxels = int(math.prod(crop_shape))
+    # contrast adjustment turns the uint16 volume into float64, except in approximate mode,
+    # where the feature workers adjust the selected voxels only
+    adjusted = any(contrast_adjustment_options) and sample_fraction is None
+    itemsize = 8 if adjusted else 2
+    raw_bytes = 0 if cached else voxels * 2
+
+    # raw volume, two float64 temporaries during adjustment and the pickled result
+    loading = raw_bytes + (2 * voxels * 8 if adjusted else 0) + voxels * itemsize
+
+    # received volume and its unpickling buffer, plus per-subcube copies and scipy temporaries
+    segment_size = min(crop_shape[1], crop_shape[2]) // min(division_list)
+    subcube_voxels = segment_size ** 3
+    if sample_fraction is not None:
+        subcube_voxels = int(math.ceil(subcube_voxels * sample_fraction))
+    n_subcubes = max((crop_shape[0] // (min(crop_shape[1], crop_shape[2]) // division)) * division ** 2 for division in division_list)
+    # the approximate mode also keeps one leave-one-group-out value per group
+    table_bytes = n_subcubes * (len(feature_list) + 1) * 8 * (n_replicates + 1 if sample_fraction is not None else 1)
+    if not cached:
+        volume_bytes = 2 * voxels * itemsize
+    elif adjusted:
+        # cached volumes are memory-mapped and adjusted by each feature task, which holds the
+        # float64 results of the subtraction, the scaling and the division at its peak
+        volume_bytes = 3 * voxels * 8
+    else:
+        volume_bytes = 0
+    features = volume_bytes + 4 * subcube_voxels * 8 + table_bytes
+
+    entropy = entropy_task_bytes(n_subcubes)
+
+    # loaded images kept by the parent, by the manager dictionary and in the items read back from it
+    parent = 0 if cached else 3 * len(contrast_adjustment_options) * voxels * itemsize
+
+    return {
+        'loading': loading + WORKER_BASELINE_BYTES,
+        'features': features + WORKER_BASELINE_BYTES,
+        'entropy': entropy + WORKER_BASELINE_BYTES,
+        'parent': parent
+    }
+
+def plan_stages(crop_shape, contrast_adjustment_options, division_list, feature_list, sample_fraction=None, n_replicates=1, cached=False, memory_fraction=0.8, max_workers=None):
+    """
+    Chooses the number of concurrent workers and the chunk size of each pool stage so
+    that the sample runs with the maximum concurrency that fits the memory budget.
+
+    Parameters:
+    crop_shape (tuple): Shape (z, x, y) of the cropped sample volume.
+    contrast_adjustment_options (list of bool): List of contrast adjustment flags.
+    division_list (list of int): List of division values.
+    feature_list (list of str): List of feature names.
+    sample_fraction (float or None): Voxel fraction of the approximate mode, or None.
+    n_replicates (int): Number of jackknife groups of the approximate mode.
+    cached (bool): Whether the raw volume is memory-mapped from the volume cache.
+    memory_fraction (float): Fraction of the available memory that may be used (default is 0.8).
+    max_workers (int or None): Upper bound on workers, such as the pool size (default is None).
+
+    Returns:
+    dict: For each stage ('loading', 'features', 'entropy'), a dict with 'tasks', 'workers',
+          'chunksize', 'task_bytes' and 'fits' (whether one task fits the budget), plus 
+          'budget_bytes' and 'parent_bytes'.
+    """
+    estimates = estimate_stage_memory(crop_shape, contrast_adjustment_options, division_list, feature_list, sample_fraction, n_replicates, cached)
+    cpus = available_cpus()
+    if max_workers is not None:
+        cpus = min(cpus, max_workers)
+    available = available_memory_bytes()
+    budget = None if available is None else int(available * memory_fraction) - estimates['parent']
+
+    n_entropy_tasks = len(contrast_adjustment_options) * len(division_list) * len(feature_list)
+    if sample_fraction is not None:
+        n_entropy_tasks *= n_replicates + 1
+    stage_tasks = {
+        'loading': len(contrast_adjustment_options),
+        'features': len(contrast_adjustment_options) * len(division_list),
+        'entropy': n_entropy_tasks
+    }
+
+    plan = {'budget_bytes': budget, 'parent_bytes': estimates['parent']}
+    for stage, tasks in stage_tasks.items():
+        plan[stage] = plan_stage(tasks, estimates[stage], cpus, budget, chunked=stage == 'entropy')
+    return plan
+
+def plan_stage(tasks, task_bytes, cpus, budget, chunked=False):
+    """
+    Chooses the number of concurrent workers and the chunk size of one pool stage.
+
+    Parameters:
+    tasks (int): Number of tasks of the stage.
+    task_bytes (int): Estimated peak memory of one task, including the worker baseline.
+    cpus (int): Maximum number of workers.
+    budget (int or None): Memory budget for the workers, or None if unknown.
+    chunked (bool): Whether small tasks are grouped in chunks (default is False).
+
+    Returns:
+    dict: 'tasks', 'workers', 'chunksize', 'task_bytes' and 'fits' of the stage.
+    """
+    workers = min(tasks, cpus)
+    if budget is not None:
+        workers = min(workers, budget // task_bytes)
+    workers = max(1, int(workers))
+    return {
+        'tasks': tasks,
+        'workers': workers,
+        # small tasks are grouped to reduce scheduling overhead, large ones are sent one by one
+        'chunksize': max(1, math.ceil(tasks / (workers * 4))) if chunked else 1,
+        'task_bytes': task_bytes,
+        'fits': budget is None or budget >= task_bytes
+    }
+
+def plan_entropy_stage(tasks, max_values, memory_fraction=0.8, max_workers=None):
+    """
+    Plans an entropy stage whose tasks do not come from a single sample, such as the 
+    reference entropies recomputed by the corpus builder.
+
+    Parameters:
+    tasks (int): Number of entropy tasks.
+    max_values (int): Largest number of feature values of a task.
+    memory_fraction (float): Fraction of the available memory that may be used (default is 0.8).
+    max_workers (int or None): Upper bound on workers, such as the pool size (default is None).
+
+    Returns:
+    dict: Stage plan, as in the stages of plan_stages.
+    """
+    cpus = available_cpus()
+    if max_workers is not None:
+        cpus = min(cpus, max_workers)
+    available = available_memory_bytes()
+    budget = None if available is None else int(available * memory_fraction)
+    return plan_stage(tasks, entropy_task_bytes(max_values) + WORKER_BASELINE_BYTES, cpus, budget, chunked=True)
+
+def print_plan(plan):
+    """
+    Logs a concurrency plan.
+
+    Parameters:
+    plan (dict): Plan returned by plan_stages.
+
+    Returns:
+    None
+    """
+    gib = 1024 ** 3
+    budget = 'unknown' if plan['budget_bytes'] is None else f'{plan["budget_bytes"] / gib:.2f} GiB'
+    print(f'Resource plan: memory budget for workers {budget}, parent process {plan["parent_bytes"] / gib:.2f} GiB.', flush=True)
+    for stage in ['loading', 'features', 'entropy']:
+        stage_plan = plan[stage]
+        print(f'Resource plan: {stage} stage with {stage_plan["workers"]} workers for {stage_plan["tasks"]} tasks, '
+              f'chunk size {stage_plan["chunksize"]}, {stage_plan["task_bytes"] / gib:.2f} GiB per task.', flush=True)
+        if not stage_plan['fits']:
+            print(f'WARNING: a single {stage} task is estimated to exceed the memory budget.', flush=True)
+
+def map_chunk(func, chunk):
+    """
+    Applies a function to every item of a chunk, inside a worker process.
+
+    Parameters:
+    func (callable): Function to apply.
+    chunk (list): Items of the chunk.
+
+    Returns:
+    list: Results for each item.
+    """
+    return [func(item) for item in chunk]
+
+def bounded_map(pool, func, items, max_workers, chunksize=1):
+    """
+    Maps a function over items using a pool, with at most max_workers chunks running at
+    the same time, so a larger shared pool can enforce the concurrency of each stage.
+
+    Parameters:
+    pool (multiprocessing.Pool): Worker pool.
+    func (callable): Picklable function to apply.
+    items (iterable): Items to process.
+    max_workers (int): Maximum number of chunks processed concurrently.
+    chunksize (int): Number of items per chunk (default is 1).
+
+    Returns:
+    list: Results in the order of items.
+    """
+    items = list(items)
+    chunks = [items[i:i + chunksize] for i in range(0, len(items), chunksize)]
+    slots = threading.BoundedSemaphore(max_workers)
+    release = lambda _: slots.release()
+    async_results = []
+    for chunk in chunks:
+        slots.acquire()
+        async_results.append(pool.apply_async(map_chunk, (func, chunk), callback=release, error_callback=release))
+    return [result for async_result in async_results for result in async_result.get()]
+
+def bounded_submit(pool, func, items, max_workers):
+    """
+    Submits a function over items to a pool without waiting for the results, with at most
+    max_workers items running at the same time. Items are submitted in order by a
+    background thread, so later items start as soon as earlier ones finish.
+
+    Parameters:
+    pool (multiprocessing.Pool): Worker pool.
+    func (callable): Picklable function to apply.
+    items (iterable): Items to process.
+    max_workers (int): Maximum number of items processed concurrently.
+
+    Returns:
+    list of concurrent.futures.Future: One future per item, in the order of items. 
+                                       Cancelling a future that has not been submitted 
+                                       yet keeps it from being sent to the pool.
+    """
+    items = list(items)
+    futures = [Future() for _ in items]
+    slots = threading.BoundedSemaphore(max_workers)
+
+    def submit():
+        for item, future in zip(items, futures):
+            slots.acquire()
+            if not future.set_running_or_notify_cancel():
+                slots.release()
+                continue
+            def on_result(result, future=future):
+                slots.release()
+                future.set_result(result)
+            def on_error(error, future=future):
+                slots.release()
+                future.set_exception(error)
+            pool.apply_async(func, (item,), callback=on_result, error_callback=on_error)
+
+    threading.Thread(target=submit, daemon=True).start()
+    return futures
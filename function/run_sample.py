@@ -1,41 +1,78 @@
 # run_sample.py
 
+import time
+STARTUP_TIME = time.time()
+
 import os
 import pandas as pd
-from multiprocessing import Pool, Manager, cpu_count
+from multiprocessing import Manager, get_context
 from functools import partial
-import itertools
 import argparse
-import time
 from datetime import datetime
 import subprocess
+import sys
 
-from views_plot import plot_views_from_sample
-from parser_utils import str2bool, list_of_bools, list_of_ints, list_of_strings, int_or_none
+from parser_utils import str2bool, list_of_bools, list_of_ints, list_of_strings, int_or_none, float_or_none
 from image_preprocessing_utils import (
     load_and_preprocess_image, generate_expanded_dataset, get_rectangle_bounds, get_info, get_contrast_adjustments_values, check_image_dtype
 )
-from feature_calculation_utils import generate_pool_dict, compute_image_statistics, export_features
+from feature_calculation_utils import generate_pool_dict, compute_image_statistics, export_features, iter_feature_columns, APPROXIMATE_FEATURES
 from rank_calculation_utils import (
     entropy, calculate_sample_entropy, process_adjustment_division_feature, 
-    generate_entropy_df, calculate_sample_rank
+    generate_entropy_df, calculate_sample_rank, summarize_entropy_jackknife, calculate_sample_rank_interval,
+    max_rank_change, load_reference_scaler_stats
+)
+from resource_planner import available_cpus, plan_stages, print_plan, bounded_map, bounded_submit
+from volume_cache import (
+    volume_cache_key, read_cached_volume, write_cached_volume, cache_views_plot, restore_views_plot, pin_cached_volume, unpin_cached_volume
 )
 
-def heterogeneity_rank(sample_path, features_folder, output_folder, data_rank_path, data_entropy_path, division_list, contrast_adjustment_options, feature_list, z_ini, z_fin):
-    start = time.time()
+# modules imported once by the forkserver before forking worker processes; the main
+# module is included so that workers do not re-import it one by one
+WORKER_PRELOAD = ['__main__', 'numpy', 'scipy.stats', 'feature_calculation_utils']
 
-    # check if specified path is a 16bit image, else stops execution
-    check_image_dtype(sample_path)
-        
-    # load entropy and rank data for previously calculated samples
-    data_entropy = pd.read_csv(data_entropy_path)
+def append_to_csv(df, path):
+    """
+    Appends a DataFrame to a CSV file, writing the header only when the file is created.
 
-    # get sample name from sample_path
-    sample_name = sample_path.split('/')[-1].split('.')[0]
+    Parameters:
+    df (pd.DataFrame): DataFrame to be written.
+    path (str): Path to the CSV file.
 
-    print(f'Sample: {sample_name}', flush = True)
+    Returns:
+    None
+    """
+    df.to_csv(path, mode='a', header=not os.path.exists(path), index=False)
 
-    # process image, calculate features, calculate entropy and recalculate rank for new samples
+def create_worker_pool(processes):
+    """
+    Creates a worker pool whose processes are forked from a forkserver preloaded 
+    with NumPy, SciPy and the feature calculation functions, so that workers start 
+    without re-importing them.
+
+    Parameters:
+    processes (int): Number of worker processes.
+
+    Returns:
+    multiprocessing.Pool: The worker pool.
+    """
+    context = get_context('forkserver')
+    context.set_forkserver_preload(WORKER_PRELOAD)
+    return context.Pool(processes)
+
+def prepare_sample_dataset(sample_path, z_ini, z_fin):
+    """
+    Defines the image cuts of a sample and its voidmean and rockmedian values.
+
+    Parameters:
+    sample_path (str): Path to the .nc sample file.
+    z_ini (int or None): Starting index on the Z-axis, or None to guess it.
+    z_fin (int or None): Ending index on the Z-axis, or None to guess it.
+
+    Returns:
+    pd.DataFrame: Single-row DataFrame with columns 'dataset', 'voidmean', 'rockmedian', 
+                  'z_ini', 'z_fin', 'x_ini', 'x_fin', 'y_ini' and 'y_fin'.
+    """
     # get cropped image bounds
     cuts_start = time.time()
     print('Image cuts definition began.', flush = True)
@@ -55,93 +92,293 @@ def heterogeneity_rank(sample_path, features_folder, output_folder, data_rank_pa
 
     # store sample dataframe (memory) with info needed for rank calculation
     dfdataset = pd.merge(contrast_df, bounds_df, on='dataset')
-    print('Sample dataset created.', flush = True)
-    
-    # Define the output folder path with sample name and timestamp
-    timestamp = datetime.now().strftime('%d%m%Y_%H%M%S')
-    output_folder = os.path.join(output_folder, f'{sample_name}_{timestamp}')
-    os.makedirs(output_folder, exist_ok=True)
-    
-    #Plot views
-    plot_start = time.time()
-    print('Started plotting views', flush = True)
-    plot_views_from_sample(dfdataset, output_folder)
-    plot_end = time.time()
-    print(f'Plotting views ended. Time elapsed (seconds): {plot_end - plot_start}', flush=True)
-    
-    # begin feature calculation
-    feature_start = time.time()
-    print('Feature calculation started.', flush=True)
-    
-    # Consider different options of contrast adjustment
-    dfcrops_expanded = generate_expanded_dataset(dfdataset, contrast_adjustment_options)
-    sample_info_path = os.path.join(output_folder,f'info_{sample_name}.csv')
-    dfcrops_expanded.to_csv(sample_info_path, index = False)
-    print(f'Sample info saved to {sample_info_path}')
-                                
-    if dfcrops_expanded.shape[0] == 1:
+    return dfdataset
+
+def load_sample_images(dfcrops_expanded, pool, max_workers=None, adjust=True):
+    """
+    Loads the cropped sample image for each contrast adjustment option.
+
+    Parameters:
+    dfcrops_expanded (pd.DataFrame): Sample dataset expanded by contrast adjustment options.
+    pool (multiprocessing.Pool): Worker pool used when there is more than one option.
+    max_workers (int or None): Maximum number of images loaded concurrently, or None to 
+                               use the whole pool (default is None).
+    adjust (bool): Whether to apply the contrast adjustment. When False, the raw uint16 
+                   volume is loaded once and shared by every option (default is True).
+
+    Returns:
+    list of tuples: (sample name, image, contrast adjustment) for each option. For cached 
+                    volumes the image is the dataset row, loaded later by the feature workers.
+    """
+    loading_start = time.time()
+    print('Image loading started.', flush=True)
+    if 'cache_path' in dfcrops_expanded.columns:
+        # cached volumes are memory-mapped by the feature workers themselves
+        sample_images = [
+            (row['dataset'].split('/')[-1][:-3], row, row['contrast_adjustment'])
+            for _, row in dfcrops_expanded.iterrows()
+        ]
+    elif not adjust:
+        # the raw volume is the same for every contrast adjustment option
+        sample, im, _ = load_and_preprocess_image((0, dfcrops_expanded.iloc[0]), adjust=False)
+        sample_images = [(sample, im, adjustment) for adjustment in dfcrops_expanded['contrast_adjustment']]
+    elif dfcrops_expanded.shape[0] == 1:
         row = dfcrops_expanded.iloc[0]
         sample_images = [load_and_preprocess_image((0, row))]
+    elif max_workers is not None:
+        sample_images = bounded_map(pool, load_and_preprocess_image, dfcrops_expanded.iterrows(), max_workers)
     else:
-        with Pool(2) as pool:
-            sample_images = pool.map(
-                partial(load_and_preprocess_image), dfcrops_expanded.iterrows()
-            )
+        sample_images = pool.map(
+            partial(load_and_preprocess_image), dfcrops_expanded.iterrows()
+        )
+    loading_end = time.time()
+    print(f'Image loading ended. Time elapsed (seconds): {loading_end - loading_start}', flush=True)
+    return sample_images
+
+def heterogeneity_rank(sample_path, features_folder, output_folder, data_rank_path, data_entropy_path, division_list, contrast_adjustment_options, feature_list, z_ini, z_fin,
+                       sample_fraction=None, sampling='random', n_replicates=10, confidence=0.95, seed=None,
+                       progressive=False, rank_stability_tol=None, rank_stability_patience=1, on_division_ranked=None,
+                       data_entropy=None, scaler_stats=None, pool=None, cache_folder=None, cache_budget_gb=50, cache_grace_seconds=300, memory_fraction=0.8):
+    start = time.time()
+    approximate = sample_fraction is not None
+    if approximate and not 0 < sample_fraction <= 1:
+        print(f'ERROR: sample_fraction must be in (0, 1], got {sample_fraction}', flush = True)
+        sys.exit(1)
+    if rank_stability_tol is not None and not progressive:
+        print('ERROR: rank_stability_tol requires progressive mode', flush = True)
+        sys.exit(1)
+    if approximate and n_replicates < 2:
+        print(f'ERROR: n_replicates must be at least 2 in approximate mode, got {n_replicates}', flush = True)
+        sys.exit(1)
+    if approximate:
+        excluded_features = [feature for feature in feature_list if feature not in APPROXIMATE_FEATURES]
+        feature_list = [feature for feature in feature_list if feature in APPROXIMATE_FEATURES]
+        if excluded_features:
+            print(f'Approximate mode: features {excluded_features} are not supported and were left out.', flush = True)
+        if not feature_list:
+            print(f'ERROR: approximate mode supports only the features {APPROXIMATE_FEATURES}', flush = True)
+            sys.exit(1)
+
+    # look up the cropped volume in the sidecar cache, pinning it first so that other runs
+    # do not evict it while the workers of this run memory-map it
+    cached_info = None
+    cache_pin = None
+    if cache_folder is not None:
+        os.makedirs(cache_folder, exist_ok=True)
+        cache_key = volume_cache_key(sample_path, z_ini, z_fin, cache_folder)
+        cache_pin = pin_cached_volume(cache_folder, cache_key)
+        cached_info = read_cached_volume(cache_folder, cache_key)
+
+    # check if specified path is a 16bit image, else stops execution
+    if cached_info is None:
+        try:
+            check_image_dtype(sample_path)
+        except SystemExit:
+            if cache_pin is not None:
+                unpin_cached_volume(cache_pin)
+            raise
         
-    # create dictionary with images and different grid choices
-    pool_dict = generate_pool_dict(sample_images, division_list)
+    # start worker processes, shared by all stages, unless a pool is provided by the caller
+    owns_pool = pool is None
+    if owns_pool:
+        pool_start = time.time()
+        pool = create_worker_pool(available_cpus())
+        pool_end = time.time()
+        print(f'Worker pool spin-up ended. Time elapsed (seconds): {pool_end - pool_start}', flush = True)
 
-    prepared_dict_items = [((key[0], key[1], key[2]), value) for key, value in pool_dict.items()]
-    
-    with Pool(min(len(pool_dict), cpu_count())) as pool:
-        features_results = pool.map(
-            partial(compute_image_statistics, feature_list=feature_list),
-            prepared_dict_items
-    )
-    feature_end = time.time()
-    print(f'Feature calculation ended. Time elapsed (seconds): {feature_end - feature_start}', flush=True)
-
-    # store sample features for each subcube
-    df_sample_features = export_features(features_results, sample_name, feature_list)
-    features_output_path = os.path.join(output_folder, f'features_{sample_name}.csv')
-    df_sample_features.to_csv(features_output_path, index=False)
-    print(f'Features for sample {sample_name} saved to {features_output_path}.', flush = True)
-
-    # begin entropy calculation
-    entropy_start = time.time()
-    print('Entropy calculation began.', flush = True)
-
-    # create list with chosen options of contrast adjustment, grid values, and features
-    combinations_entropy = list(itertools.product(contrast_adjustment_options, division_list, feature_list))
-
-    # calculate sample entropy
-    pool_size = min(len(combinations_entropy), cpu_count())
-    with Pool(pool_size) as pool:
-        entropy_results = pool.map(partial(process_adjustment_division_feature, features_folder = features_folder, df_sample_features = df_sample_features, sample = sample_name), combinations_entropy)
-    entropy_end = time.time()
-    print(f'Entropy calculation ended. Time elapsed (seconds): {entropy_end - entropy_start}.', flush = True)
+    feature_futures = []
+    stopped_early = False
+    try:
+        # load entropy and rank data for previously calculated samples, unless already loaded by the caller
+        if data_entropy is None:
+            data_entropy = pd.read_csv(data_entropy_path)
+
+        # load reference feature grid statistics used to scale sample features
+        if scaler_stats is None:
+            scaler_stats = load_reference_scaler_stats(features_folder, contrast_adjustment_options, division_list, feature_list)
+
+        # get sample name from sample_path
+        sample_name = sample_path.split('/')[-1].split('.')[0]
+
+        print(f'Sample: {sample_name}', flush = True)
+        if approximate:
+            print(f'Approximate mode: {sampling} sampling of {sample_fraction} of the voxels, split into {n_replicates} jackknife groups.', flush = True)
+
+        # process image, calculate features, calculate entropy and recalculate rank for new samples
+        if cached_info is not None:
+            print(f'Cached volume found at {cached_info["cache_path"]}, image cuts and voidmean/rockmedian reused.', flush = True)
+            cached_info['dataset'] = sample_path
+            dfdataset = pd.DataFrame([cached_info])
+        else:
+            dfdataset = prepare_sample_dataset(sample_path, z_ini, z_fin)
+            if cache_folder is not None:
+                cache_start = time.time()
+                dfdataset['cache_path'] = write_cached_volume(cache_folder, cache_key, dfdataset.iloc[0], int(cache_budget_gb * 1024 ** 3), cache_grace_seconds)
+                cache_end = time.time()
+                print(f'Cropped volume cached to {dfdataset["cache_path"].iloc[0]}. Time elapsed (seconds): {cache_end - cache_start}', flush = True)
+        print('Sample dataset created.', flush = True)
+
+        # choose the concurrency of each stage from the crop size and the available memory
+        row = dfdataset.iloc[0]
+        crop_shape = (int(row['z_fin']) - int(row['z_ini']), int(row['x_fin']) - int(row['x_ini']), int(row['y_fin']) - int(row['y_ini']))
+        plan = plan_stages(crop_shape, contrast_adjustment_options, division_list, feature_list, sample_fraction, n_replicates,
+                           cached='cache_path' in dfdataset.columns, memory_fraction=memory_fraction)
+        print_plan(plan)
     
-    # store sample entropy in a dataframe (memory)
-    entropy_sample_df = generate_entropy_df(entropy_results)
-    entropy_output_path = os.path.join(output_folder, f'entropy_{sample_name}.csv')
-    entropy_sample_df.to_csv(entropy_output_path, index = False)
-    print(f'Entropy file saved to {entropy_output_path}', flush = True)
-
-    rank_start = time.time()
-    print(f'Rank calculation for sample {sample_name} began.', flush = True)
+        # Define the output folder path with sample name and timestamp
+        timestamp = datetime.now().strftime('%d%m%Y_%H%M%S')
+        output_folder = os.path.join(output_folder, f'{sample_name}_{timestamp}')
+        os.makedirs(output_folder, exist_ok=True)
     
-    # recalculate rank considering new sample       
-    entropy_sample_rank_df = calculate_sample_rank(data_entropy, entropy_sample_df, feature_list, output_folder)
-    rank_end = time.time()
-    print(f'Rank calculation for sample {sample_name} ended. Time elapsed: {rank_end - rank_start}', flush = True)
-
-    # save sample rank
-    rank_output_path = os.path.join(output_folder, f'rank_{sample_name}.csv')
-    entropy_sample_rank_df.to_csv(rank_output_path, index = False)
-    print(f'Rank file saved to {rank_output_path}', flush = True)
+        #Plot views
+        plot_start = time.time()
+        print('Started plotting views', flush = True)
+        plot_path = os.path.join(output_folder, f'plot_views_{sample_name}.jpeg')
+        if cached_info is not None and restore_views_plot(cache_folder, cache_key, plot_path):
+            print(f'Saved plot to {plot_path} from cache', flush = True)
+        else:
+            from views_plot import plot_views_from_sample
+            plot_views_from_sample(dfdataset, output_folder)
+            if cache_folder is not None:
+                cache_views_plot(cache_folder, cache_key, plot_path)
+        plot_end = time.time()
+        print(f'Plotting views ended. Time elapsed (seconds): {plot_end - plot_start}', flush=True)
     
-    end = time.time()
-    print(f'Total time (seconds): {end - start}', flush = True)
+        # Consider different options of contrast adjustment
+        dfcrops_expanded = generate_expanded_dataset(dfdataset, contrast_adjustment_options)
+        sample_info_path = os.path.join(output_folder,f'info_{sample_name}.csv')
+        dfcrops_expanded.to_csv(sample_info_path, index = False)
+        print(f'Sample info saved to {sample_info_path}')
+
+        # load cropped images for each contrast adjustment option; in approximate mode the raw
+        # volume is sent to the feature workers, which adjust the selected voxels only
+        sample_images = load_sample_images(dfcrops_expanded, pool, plan['loading']['workers'], adjust=not approximate)
+        contrast_values = (float(row['voidmean']), float(row['rockmedian'])) if approximate else None
+
+        features_output_path = os.path.join(output_folder, f'features_{sample_name}.csv')
+        entropy_output_path = os.path.join(output_folder, f'entropy_{sample_name}.csv')
+        rank_output_path = os.path.join(output_folder, f'rank_{sample_name}.csv')
+
+        # in progressive mode divisions are processed from coarse to fine, one at a time,
+        # and results are appended to the output files as soon as each division is ranked
+        if progressive:
+            division_batches = [[division] for division in sorted(division_list)]
+        else:
+            division_batches = [division_list]
+
+        # begin feature calculation
+        feature_start = time.time()
+        print('Feature calculation started.', flush=True)
+
+        # create dictionary with images and different grid choices
+        pool_dict = generate_pool_dict(sample_images, division_list)
+
+        prepared_dict_items = [((key[0], key[1], key[2]), value) for key, value in pool_dict.items()]
+
+        # all feature tasks are submitted up front, coarse divisions first, so the pool stays
+        # busy with finer divisions while coarser ones are ranked
+        prepared_dict_items.sort(key=lambda item: item[0][2])
+        feature_futures = bounded_submit(
+            pool,
+            partial(compute_image_statistics, feature_list=feature_list, sample_fraction=sample_fraction,
+                    n_replicates=n_replicates, sampling=sampling, seed=seed, contrast_values=contrast_values),
+            prepared_dict_items, plan['features']['workers']
+        )
+
+        rank_dfs = []
+        previous_rank_df = None
+        stable_divisions = 0
+        for divisions in division_batches:
+            if progressive:
+                print(f'Division {divisions[0]} started.', flush=True)
+
+            # wait for the feature tables of the divisions in this batch
+            features_results = [
+                future.result() for (key, _), future in zip(prepared_dict_items, feature_futures) if key[2] in divisions
+            ]
+            feature_end = time.time()
+            print(f'Feature calculation ended. Time elapsed (seconds): {feature_end - feature_start}', flush=True)
+
+            # store sample features for each subcube
+            df_sample_features = export_features(features_results, sample_name, feature_list)
+            append_to_csv(df_sample_features, features_output_path)
+            print(f'Features for sample {sample_name} saved to {features_output_path}.', flush = True)
+
+            # begin entropy calculation
+            entropy_start = time.time()
+            print('Entropy calculation began.', flush = True)
+
+            # create list with chosen options of contrast adjustment, grid values, and features,
+            # each carrying only the sample's feature column it needs
+            combinations_entropy = list(iter_feature_columns(features_results, feature_list))
+
+            # calculate sample entropy
+            entropy_results = bounded_map(pool, partial(process_adjustment_division_feature, features_folder = features_folder, sample = sample_name, scaler_stats = scaler_stats),
+                                          combinations_entropy, plan['entropy']['workers'], plan['entropy']['chunksize'])
+            entropy_end = time.time()
+            print(f'Entropy calculation ended. Time elapsed (seconds): {entropy_end - entropy_start}.', flush = True)
+        
+            # store sample entropy in a dataframe (memory); in approximate mode the point estimate
+            # comes from the whole subsample and the jackknife replicates give its interval
+            entropy_sample_df = generate_entropy_df([result for combination, result in zip(combinations_entropy, entropy_results) if combination[3] is None])
+            if approximate:
+                entropy_replicates_df = generate_entropy_df([result for combination, result in zip(combinations_entropy, entropy_results) if combination[3] is not None])
+                entropy_sample_df = summarize_entropy_jackknife(entropy_sample_df, entropy_replicates_df, feature_list, confidence)
+            append_to_csv(entropy_sample_df, entropy_output_path)
+            print(f'Entropy file saved to {entropy_output_path}', flush = True)
+
+            rank_start = time.time()
+            print(f'Rank calculation for sample {sample_name} began.', flush = True)
+        
+            # recalculate rank considering new sample       
+            if approximate:
+                entropy_sample_rank_df = calculate_sample_rank_interval(data_entropy, entropy_sample_df, feature_list, output_folder)
+            else:
+                entropy_sample_rank_df = calculate_sample_rank(data_entropy, entropy_sample_df, feature_list, output_folder)
+            rank_end = time.time()
+            print(f'Rank calculation for sample {sample_name} ended. Time elapsed: {rank_end - rank_start}', flush = True)
+
+            # save sample rank
+            append_to_csv(entropy_sample_rank_df, rank_output_path)
+            rank_dfs.append(entropy_sample_rank_df)
+            print(f'Rank file saved to {rank_output_path}', flush = True)
+
+            if on_division_ranked is not None:
+                on_division_ranked(divisions, entropy_sample_rank_df)
+
+            # stop once ranks change less than the tolerance across successive divisions
+            if progressive and rank_stability_tol is not None:
+                if previous_rank_df is not None:
+                    change = max_rank_change(previous_rank_df, entropy_sample_rank_df, feature_list)
+                    print(f'Maximum rank change from previous division: {change}', flush = True)
+                    stable_divisions = stable_divisions + 1 if change <= rank_stability_tol else 0
+                    if stable_divisions >= rank_stability_patience:
+                        print(f'Ranks stable for {stable_divisions} successive divisions, finer divisions skipped.', flush = True)
+                        # feature tasks not sent to the pool yet are dropped, running ones are ignored
+                        # on a shared pool and stopped with the pool when it is owned
+                        for future in feature_futures:
+                            future.cancel()
+                        stopped_early = True
+                        break
+                previous_rank_df = entropy_sample_rank_df
+
+        end = time.time()
+        print(f'Total time (seconds): {end - start}', flush = True)
+
+        return pd.concat(rank_dfs, ignore_index=True)
+    finally:
+        # the pool is released on errors and early exits as well, after dropping the
+        # feature tasks that were not sent to it yet
+        for future in feature_futures:
+            future.cancel()
+        if owns_pool:
+            if stopped_early:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+        if cache_pin is not None:
+            unpin_cached_volume(cache_pin)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -155,8 +392,21 @@ if __name__ == "__main__":
     parser.add_argument("-feature_list", type=list_of_strings, default='mean,std,min,max,skewness,kurtosis,"variation coefficient",median')
     parser.add_argument("-z_ini", type=int_or_none, default= None)
     parser.add_argument("-z_fin", type=int_or_none, default= None)
+    parser.add_argument("-sample_fraction", type=float_or_none, default= None)
+    parser.add_argument("-sampling", type=str, default='random', choices=['random', 'strided'])
+    parser.add_argument("-n_replicates", type=int, default=10)
+    parser.add_argument("-confidence", type=float, default=0.95)
+    parser.add_argument("-seed", type=int_or_none, default= None)
+    parser.add_argument("-progressive", type=str2bool, default=False)
+    parser.add_argument("-rank_stability_tol", type=float_or_none, default= None)
+    parser.add_argument("-rank_stability_patience", type=int, default=1)
+    parser.add_argument("-cache_folder", type=str, default=None)
+    parser.add_argument("-cache_budget_gb", type=float, default=50)
+    parser.add_argument("-cache_grace_seconds", type=float, default=300)
+    parser.add_argument("-memory_fraction", type=float, default=0.8)
 
     args = parser.parse_args()
+    print(f'Startup time until first stage (seconds): {time.time() - STARTUP_TIME}', flush = True)
     heterogeneity_rank(sample_path = args.sample_path,
                        features_folder = args.features_folder,
                        output_folder = args.output_folder,
@@ -166,4 +416,16 @@ if __name__ == "__main__":
                        contrast_adjustment_options = args.contrast_adjustment_options,
                        feature_list = args.feature_list,
                        z_ini = args.z_ini,
-                       z_fin = args.z_fin)
\ No newline at end of file
+                       z_fin = args.z_fin,
+                       sample_fraction = args.sample_fraction,
+                       sampling = args.sampling,
+                       n_replicates = args.n_replicates,
+                       confidence = args.confidence,
+                       seed = args.seed,
+                       progressive = args.progressive,
+                       rank_stability_tol = args.rank_stability_tol,
+                       rank_stability_patience = args.rank_stability_patience,
+                       cache_folder = args.cache_folder,
+                       cache_budget_gb = args.cache_budget_gb,
+                       cache_grace_seconds = args.cache_grace_seconds,
+                       memory_fraction = args.memory_fraction)
\ No newline at end of file
@@ -0,0 +1,311 @@
+# volume_cache.py
+
+import os
+import time
+import json
+import shutil
+import socket
+import uuid
+import numpy as np
+
+from image_preprocessing_utils import file_content_hash
+
+# file mapping source paths to their content hash, so unchanged sources are not re-hashed
+SOURCE_INDEX_FILE = 'sources.json'
+
+# entries used more recently than this are not evicted, which covers the time between a run
+# looking an entry up and pinning it
+EVICTION_GRACE_SECONDS = 300
+
+# pins left by runs on other hosts, whose process cannot be checked, expire after this time
+REMOTE_PIN_SECONDS = 24 * 3600
+
+def write_json_atomic(data, path):
+    """
+    Writes a JSON file atomically, by writing a uniquely named temporary file and renaming 
+    it over the destination, so that concurrent runs do not share the temporary file.
+
+    Parameters:
+    data (dict): Data to be written.
+    path (str): Path to the JSON file.
+
+    Returns:
+    None
+    """
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def source_hash(sample_path, cache_folder):
+    """
+    Returns the content hash of a sample file. Hashes are kept in an index in the cache
+    folder and reused while the file size and modification time do not change.
+
+    Parameters:
+    sample_path (str): Path to the .nc sample file.
+    cache_folder (str): Path to the cache folder.
+
+    Returns:
+    str: Hexadecimal content hash of the sample file.
+    """
+    index_path = os.path.join(cache_folder, SOURCE_INDEX_FILE)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+
+    path = os.path.abspath(sample_path)
+    stat = os.stat(path)
+    entry = index.get(path)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+        return entry['hash']
+
+    content_hash = file_content_hash(path)
+    index[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': content_hash}
+    write_json_atomic(index, index_path)
+    return content_hash
+
+def volume_cache_key(sample_path, z_ini, z_fin, cache_folder):
+    """
+    Builds the cache key of a cropped sample volume from the source content hash and the
+    requested Z bounds, which change the crop.
+
+    Parameters:
+    sample_path (str): Path to the .nc sample file.
+    z_ini (int or None): Requested starting index on the Z-axis.
+    z_fin (int or None): Requested ending index on the Z-axis.
+    cache_folder (str): Path to the cache folder.
+
+    Returns:
+    str: Cache key.
+    """
+    return f'{source_hash(sample_path, cache_folder)[:32]}_{z_ini}_{z_fin}'
+
+def cache_paths(cache_folder, key):
+    """
+    Returns the paths of the files stored for a cache entry.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+    key (str): Cache key.
+
+    Returns:
+    dict: Paths of the 'volume' (.npy), 'info' (.json) and 'views' (.jpeg) files.
+    """
+    return {
+        'volume': os.path.join(cache_folder, f'{key}.npy'),
+        'info': os.path.join(cache_folder, f'{key}.json'),
+        'views': os.path.join(cache_folder, f'{key}.jpeg')
+    }
+
+def read_cached_volume(cache_folder, key):
+    """
+    Looks up a cached sample volume, marking it as recently used.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+    key (str): Cache key.
+
+    Returns:
+    dict or None: Sample info (dataset, bounds, voidmean, rockmedian and cache_path), or
+                  None if the volume is not cached.
+    """
+    paths = cache_paths(cache_folder, key)
+    if not (os.path.exists(paths['volume']) and os.path.exists(paths['info'])):
+        return None
+    with open(paths['info']) as f:
+        info = json.load(f)
+    os.utime(paths['volume'])
+    info['cache_path'] = paths['volume']
+    return info
+
+def write_cached_volume(cache_folder, key, row, budget_bytes, grace_seconds=EVICTION_GRACE_SECONDS):
+    """
+    Writes the cropped uint16 volume of a sample as an uncompressed .npy file that can be
+    memory-mapped, along with its bounds, voidmean and rockmedian, then evicts old entries
+    to stay within the disk budget.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+    key (str): Cache key.
+    row (pd.Series): Sample dataset row with 'dataset', bounds, 'voidmean' and 'rockmedian'.
+    budget_bytes (int): Maximum total size of the cached volumes, in bytes.
+    grace_seconds (float): Eviction grace period, see evict_cache (default is EVICTION_GRACE_SECONDS).
+
+    Returns:
+    str: Path of the cached volume.
+    """
+    import xarray as xr
+
+    paths = cache_paths(cache_folder, key)
+    with xr.open_dataset(row['dataset']) as db:
+        im = np.array(db['microtom'][int(row['z_ini']):int(row['z_fin']), int(row['x_ini']):int(row['x_fin']), int(row['y_ini']):int(row['y_fin'])])
+
+    tmp_path = f'{paths["volume"]}.{uuid.uuid4().hex}.tmp.npy'
+    np.save(tmp_path, im)
+    os.replace(tmp_path, paths['volume'])
+
+    info = {column: row[column] for column in ['dataset', 'voidmean', 'rockmedian', 'z_ini', 'z_fin', 'x_ini', 'x_fin', 'y_ini', 'y_fin']}
+    info = {column: value if isinstance(value, str) else float(value) for column, value in info.items()}
+    write_json_atomic(info, paths['info'])
+
+    evict_cache(cache_folder, budget_bytes, keep=[key], grace_seconds=grace_seconds)
+    return paths['volume']
+
+def pin_cached_volume(cache_folder, key):
+    """
+    Marks a cache entry as in use by this process, so that other runs do not evict it 
+    while the worker processes still memory-map it.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+    key (str): Cache key.
+
+    Returns:
+    str: Path of the pin file, to be passed to unpin_cached_volume.
+    """
+    pin_path = os.path.join(cache_folder, f'{key}.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex}.pin')
+    open(pin_path, 'w').close()
+    return pin_path
+
+def unpin_cached_volume(pin_path):
+    """
+    Removes a pin created by pin_cached_volume.
+
+    Parameters:
+    pin_path (str): Path of the pin file.
+
+    Returns:
+    None
+    """
+    try:
+        os.remove(pin_path)
+    except FileNotFoundError:
+        pass
+
+def pinned_keys(cache_folder):
+    """
+    Returns the keys of the cache entries pinned by running processes. Pins of processes 
+    of this host that no longer run are removed.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+
+    Returns:
+    set of str: Pinned keys.
+    """
+    hostname = socket.gethostname()
+    keys = set()
+    for filename in os.listdir(cache_folder):
+        if not filename.endswith('.pin'):
+            continue
+        # cache keys have no dots, host names may have some
+        key, rest = filename.split('.', 1)
+        host, pid, _, _ = rest.rsplit('.', 3)
+        pin_path = os.path.join(cache_folder, filename)
+        if host == hostname:
+            try:
+                os.kill(int(pid), 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+        else:
+            try:
+                alive = time.time() - os.path.getmtime(pin_path) < REMOTE_PIN_SECONDS
+            except FileNotFoundError:
+                continue
+        if alive:
+            keys.add(key)
+        else:
+            unpin_cached_volume(pin_path)
+    return keys
+
+def cache_views_plot(cache_folder, key, plot_path):
+    """
+    Stores the views plot of a sample next to its cached volume.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+    key (str): Cache key.
+    plot_path (str): Path of the views plot to be cached.
+
+    Returns:
+    None
+    """
+    if os.path.exists(plot_path):
+        tmp_path = f'{cache_paths(cache_folder, key)["views"]}.{uuid.uuid4().hex}.tmp'
+        shutil.copyfile(plot_path, tmp_path)
+        os.replace(tmp_path, cache_paths(cache_folder, key)['views'])
+
+def restore_views_plot(cache_folder, key, plot_path):
+    """
+    Copies the cached views plot of a sample to the output folder.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+    key (str): Cache key.
+    plot_path (str): Destination path of the views plot.
+
+    Returns:
+    bool: True if a cached plot was restored, False otherwise.
+    """
+    views_path = cache_paths(cache_folder, key)['views']
+    if not os.path.exists(views_path):
+        return False
+    shutil.copyfile(views_path, plot_path)
+    return True
+
+def evict_cache(cache_folder, budget_bytes, keep=(), grace_seconds=EVICTION_GRACE_SECONDS):
+    """
+    Removes the least recently used cache entries until the cache fits the disk budget.
+    Entries pinned by running processes or used within the grace period are kept even if 
+    the budget is exceeded.
+
+    Parameters:
+    cache_folder (str): Path to the cache folder.
+    budget_bytes (int): Maximum total size of the cache entries, in bytes.
+    keep (iterable of str): Keys that must not be evicted.
+    grace_seconds (float): Minimum time since last use before an entry can be evicted, 
+                           covering runs that looked an entry up but did not pin it yet 
+                           (default is EVICTION_GRACE_SECONDS).
+
+    Returns:
+    list of str: Keys of the evicted entries.
+    """
+    entries = []
+    for filename in os.listdir(cache_folder):
+        if filename.endswith('.npy') and '.tmp' not in filename:
+            key = filename[:-len('.npy')]
+            paths = cache_paths(cache_folder, key)
+            # entries may be evicted by another run while they are listed
+            try:
+                size = sum(os.path.getsize(path) for path in paths.values() if os.path.exists(path))
+                entries.append((os.path.getmtime(paths['volume']), key, size))
+            except FileNotFoundError:
+                continue
+
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    now = time.time()
+    pinned = pinned_keys(cache_folder)
+    for mtime, key, size in sorted(entries):
+        if total <= budget_bytes:
+            break
+        if key in keep or key in pinned:
+            continue
+        # entries are sorted by last use, so all the remaining ones are within the grace period
+        if now - mtime < grace_seconds:
+            print(f'Volume cache exceeds its budget, entries used in the last {grace_seconds} seconds kept.', flush=True)
+            break
+        for path in cache_paths(cache_folder, key).values():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= size
+        evicted.append(key)
+        print(f'Cached volume {key} evicted.', flush=True)
+    return evicted